@@ -0,0 +1,93 @@
+import logging
+import threading
+from collections import deque
+from time import time
+
+import numpy as np
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+logger = logging.getLogger(__name__)
+
+# latency samples the p99 is taken over
+LATENCY_WINDOW = 200
+
+# a tuning step is taken every this many forward passes
+TUNE_EVERY = 10
+
+
+class AdaptiveBatchScheduler(object):
+    '''
+    Coalesces queued message batches into one forward pass of up to batch_limit images, waiting at most wait
+    seconds after the first batch for more to arrive. Both bounds are tuned from the observed p99 latency (message
+    read to inference done) against latency_target:
+
+    - over target: shrink the batch limit and the wait, so batches finish sooner
+    - under target with batches backing up: grow the batch limit, bigger forward passes drain the backlog with
+      less per-image overhead
+    - well under target and idle: grow the wait, so light traffic is still classified in fuller batches
+
+    batch_limit stays within [1, max_batch_size] and wait within [0, max_wait].
+    '''
+
+    def __init__(self, max_batch_size=64, max_wait=0.05, latency_target=2.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.latency_target = latency_target
+
+        self.batch_limit = max_batch_size
+        self.wait = max_wait
+
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.passes = 0
+        self.lock = threading.Lock()
+
+    def collect(self, inbox):
+        '''
+        Block for the next batch, then take more from inbox until batch_limit images or the wait is up. Source
+        batches are never split, so the last one taken can overshoot batch_limit.
+        '''
+        batches = [inbox.get()]
+        num_images = len(batches[0].tensors)
+        deadline = time() + self.wait
+
+        while num_images < self.batch_limit:
+            try:
+                # whatever is already queued is taken without waiting, even once the deadline has passed
+                batch = inbox.get(timeout=max(0.0, deadline - time())) if deadline > time() else inbox.get_nowait()
+            except Empty:
+                break
+
+            batches.append(batch)
+            num_images += len(batch.tensors)
+
+        return batches
+
+    def record(self, batches, inference_seconds, backlog):
+        '''
+        Called after the forward pass over batches, backlog is the number of batches still queued
+        '''
+        now = time()
+
+        with self.lock:
+            self.latencies.extend(now - batch.received_at for batch in batches)
+            self.passes += 1
+
+            if self.passes % TUNE_EVERY:
+                return
+
+            p99 = np.percentile(self.latencies, 99)
+
+            if p99 > self.latency_target:
+                self.batch_limit = max(1, int(self.batch_limit * 0.75))
+                self.wait /= 2.0
+            elif backlog:
+                self.batch_limit = min(self.max_batch_size, self.batch_limit + max(1, self.batch_limit // 4))
+            elif p99 < self.latency_target / 2.0:
+                self.wait = min(self.max_wait, max(self.wait * 1.5, 0.001))
+
+            logger.debug('Batch scheduler: p99 %.3fs, last pass %.3fs, backlog %d, limit %d images, wait %.3fs'
+                         % (p99, inference_seconds, backlog, self.batch_limit, self.wait))
@@ -0,0 +1,330 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from ClassificationPipeline import BELOW_THRESHOLD_VALUE, preload_model
+from ImageClassifier import CustomImageClassifier, INFERENCE_MODES, FROZEN_MODE
+from ImageFetcher import ImageFetcher
+from ResultCache import create_memcache_client, set_many_with_retry, url_key, content_key, ERROR_VALUE
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+# images per checkpoint - a chunk is either fully written or redone on resume
+DEFAULT_CHUNK_SIZE = 2000
+
+# images per forward pass
+DEFAULT_BATCH_SIZE = 64
+
+TSV_FORMAT = 'tsv'
+PARQUET_FORMAT = 'parquet'
+
+COLUMNS = ['input', 'label', 'score', 'error']
+
+# what the checkpoints in an output directory were made from
+MANIFEST_FILE = 'manifest.json'
+
+
+def read_inputs(input_path):
+    '''
+    Yield image urls, one per line of a file ('-' for stdin), or the paths of the images under a directory
+    '''
+    if os.path.isdir(input_path):
+        for root, dirs, files in os.walk(input_path):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, file_name)
+        return
+
+    f = sys.stdin if input_path == '-' else open(input_path, 'r')
+    try:
+        for line in f:
+            url = line.strip()
+            if url:
+                yield url
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_chunks(input_path, chunk_size):
+    '''
+    Yield (chunk number, list of inputs) without holding more than one chunk in memory
+    '''
+    inputs = read_inputs(input_path)
+    chunk_number = 0
+
+    while 1:
+        chunk = list(islice(inputs, chunk_size))
+        if not chunk:
+            return
+        yield chunk_number, chunk
+        chunk_number += 1
+
+
+def check_manifest(output_dir, input_path, chunk_size):
+    '''
+    Record the input and chunk size the checkpoints in output_dir are numbered by, or raise ValueError if they were
+    made from a different one - resuming would then skip or redo the wrong images
+    '''
+    manifest = {'input_path': input_path if input_path == '-' else os.path.abspath(input_path),
+                'chunk_size': chunk_size}
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            existing = json.load(f)
+        if existing != manifest:
+            raise ValueError("%s holds checkpoints of %s with chunk size %d, not %s with chunk size %d"
+                             % (output_dir, existing.get('input_path'), existing.get('chunk_size'),
+                                manifest['input_path'], chunk_size))
+        return
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+class ChunkWriter(object):
+    '''
+    Writes the results of a chunk as one part file (or to memcache) and marks it done. The done marker is the
+    checkpoint - it is only created once everything else for the chunk is written, so a resumed run redoes exactly
+    the chunks that did not finish.
+    '''
+
+    def __init__(self, output_dir, output_format, memcache_endpoint=None):
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.memcache_client = create_memcache_client(memcache_endpoint) if memcache_endpoint else None
+
+    def done_path(self, chunk_number):
+        return os.path.join(self.output_dir, 'chunk-%08d.done' % chunk_number)
+
+    def part_path(self, chunk_number):
+        return os.path.join(self.output_dir, 'part-%08d.%s' % (chunk_number, self.output_format))
+
+    def is_done(self, chunk_number):
+        return os.path.exists(self.done_path(chunk_number))
+
+    def write(self, chunk_number, rows, cache_writes):
+        '''
+        rows holds an (input, label, score, error) tuple per image, cache_writes the memcache key -> result writes
+        '''
+        if self.memcache_client is not None:
+            failed = set_many_with_retry(self.memcache_client, cache_writes)
+            if failed:
+                # not marked done, so the chunk is redone on resume
+                logger.error("Chunk %d: %d results not written to memcached" % (chunk_number, len(failed)))
+                return False
+        else:
+            self.write_part(self.part_path(chunk_number), rows)
+
+        open(self.done_path(chunk_number), 'w').close()
+        return True
+
+    def write_part(self, path, rows):
+        # written under a temporary name and renamed, so a part file is never half written
+        tmp_path = path + '.tmp'
+
+        if self.output_format == PARQUET_FORMAT:
+            columns = list(zip(*rows)) if rows else [[] for _ in COLUMNS]
+            table = pa.Table.from_arrays([pa.array(columns[0], pa.string()),
+                                          pa.array(columns[1], pa.string()),
+                                          pa.array(columns[2], pa.float32()),
+                                          pa.array(columns[3], pa.string())], names=COLUMNS)
+            pq.write_table(table, tmp_path)
+        else:
+            with open(tmp_path, 'w') as f:
+                for row in rows:
+                    f.write('\t'.join('' if v is None else str(v) for v in row) + '\n')
+
+        os.rename(tmp_path, path)
+
+
+def load_chunk(chunk, fetcher):
+    '''
+    Read or download the encoded bytes of every image of a chunk - runs one chunk ahead of inference
+    '''
+    if fetcher is None:
+        data = []
+        for path in chunk:
+            try:
+                with open(path, 'rb') as f:
+                    data.append((f.read(), None))
+            except IOError as e:
+                data.append((None, e))
+    else:
+        fetched, _ = fetcher.fetch_many(chunk)
+        data = [(f.data, f.error) for f in fetched]
+
+    return data
+
+
+def classify_chunk(chunk, data, image_clf, min_prob, batch_size, decoder):
+    '''
+    Batched inference over a loaded chunk, returns (rows, memcache writes) with the same values the queue readers
+    write - the label, BELOW_THRESHOLD_VALUE or ERROR_VALUE. Images are decoded batch_size at a time on decoder, one
+    batch ahead of inference, so only two batches of input tensors are held at once.
+    '''
+    images = [d for d, error in data if error is None]
+    batches = [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+
+    preds = []
+    decoding = decoder.apply_async(image_clf.preprocess_batch, (batches[0],)) if batches else None
+
+    for n in range(len(batches)):
+        batch = decoding.get()
+        if n + 1 < len(batches):
+            decoding = decoder.apply_async(image_clf.preprocess_batch, (batches[n + 1],))
+
+        batch_preds = [None] * len(batch)
+
+        predictions = image_clf.postprocess(batch, 1, min_prob)
+        results = np.where(predictions.confident, predictions.labels[:, 0], BELOW_THRESHOLD_VALUE)
+        for row, i in enumerate(predictions.rows):
+            batch_preds[i] = (results[row], float(predictions.scores[row, 0]))
+
+        preds.extend(batch_preds)
+
+    preds = iter(preds)
+    rows = []
+    cache_writes = {}
+
+    for image, (image_data, error) in zip(chunk, data):
+        pred = next(preds) if error is None else None
+
+        if pred is None:
+            rows.append((image, None, None, str(error) if error is not None else "Could not decode image"))
+            cache_writes[url_key(image)] = ERROR_VALUE
+            continue
+
+        rows.append((image, pred[0], pred[1], None))
+        cache_writes[url_key(image)] = pred[0]
+        cache_writes[content_key(image_data)] = pred[0]
+
+    return rows, cache_writes
+
+
+def bulk_worker(args, preloaded, num_workers, process_id):
+    '''
+    Classify every num_workers-th chunk of the input, starting at process_id - 1, skipping chunks already done
+    '''
+    image_clf = CustomImageClassifier(max(1, multiprocessing.cpu_count() // num_workers), 1, preloaded)
+    fetcher = None if os.path.isdir(args.input_path) else ImageFetcher(num_threads=args.fetch_threads,
+                                                                       max_per_host=args.fetch_threads)
+    writer = ChunkWriter(args.output_dir, args.format, args.memcache_endpoint)
+
+    chunks = ((n, chunk) for n, chunk in read_chunks(args.input_path, args.chunk_size)
+              if n % num_workers == process_id - 1 and not writer.is_done(n))
+
+    # reads or downloads the next chunk while the current one is classified
+    prefetcher = ThreadPool(1)
+    decoder = ThreadPool(1)
+    unwritten = 0
+
+    try:
+        current = next(chunks, None)
+        loading = prefetcher.apply_async(load_chunk, (current[1], fetcher)) if current else None
+
+        while current is not None:
+            start = time()
+            data = loading.get()
+
+            following = next(chunks, None)
+            if following is not None:
+                loading = prefetcher.apply_async(load_chunk, (following[1], fetcher))
+
+            chunk_number, chunk = current
+            rows, cache_writes = classify_chunk(chunk, data, image_clf, args.min_prob, args.batch_size, decoder)
+
+            if writer.write(chunk_number, rows, cache_writes):
+                logger.warning("Process %d: chunk %d, %d images at %.1f images/s"
+                               % (process_id, chunk_number, len(chunk), len(chunk) / (time() - start)))
+            else:
+                unwritten += 1
+
+            current = following
+    finally:
+        prefetcher.terminate()
+        decoder.terminate()
+        image_clf.close()
+        if fetcher is not None:
+            fetcher.close()
+
+    # a non-zero exit code tells main that a rerun is needed
+    if unwritten:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify a large file of image urls, or a directory of images, in '
+                                                 'bulk. Progress is checkpointed per chunk in output_dir, rerun '
+                                                 'the same command to resume.')
+    parser.add_argument('input_path', help="file of image urls ('-' for stdin) or a directory of images")
+    parser.add_argument('output_dir', help='checkpoints, and the result part files unless writing to memcached')
+    parser.add_argument('min_prob', type=float)
+    parser.add_argument('--memcache-endpoint',
+                        help='write results to memcached (host[:port], comma separated) instead of part files')
+    parser.add_argument('--format', choices=[PARQUET_FORMAT, TSV_FORMAT],
+                        default=PARQUET_FORMAT if pa is not None else TSV_FORMAT,
+                        help='part file format, parquet needs pyarrow')
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() // 4),
+                        help='worker processes, each with its own share of the cores')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--fetch-threads', type=int, default=32,
+                        help='concurrent downloads, all of them may go to the same host')
+    parser.add_argument('--inference-mode', choices=INFERENCE_MODES, default=FROZEN_MODE)
+    args = parser.parse_args()
+
+    if args.format == PARQUET_FORMAT and pa is None:
+        parser.error("--format parquet needs pyarrow installed")
+
+    if args.input_path == '-' and args.workers > 1:
+        parser.error("stdin can only be read by a single worker")
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    try:
+        check_manifest(args.output_dir, args.input_path, args.chunk_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # parsed once here and inherited by every forked worker
+    preloaded = preload_model(args.inference_mode)
+
+    start = time()
+    processes = [multiprocessing.Process(target=bulk_worker, args=(args, preloaded, args.workers, p_num))
+                 for p_num in range(1, args.workers + 1)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    failed = [p_num for p_num, p in enumerate(processes, 1) if p.exitcode != 0]
+    logger.warning("Finished in %.0fs" % (time() - start))
+
+    if failed:
+        logger.error("Processes %s failed, rerun to resume from the last checkpoint" % failed)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+from ClassificationPipeline import FileSource, run_worker, preload_models, add_model_arguments, \
+    DEFAULT_EXECUTION_CONFIG
+from ImageClassifier import INFERENCE_MODES, FROZEN_MODE
+import argparse
+import logging
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify image urls read one per line from a file or stdin')
+    parser.add_argument('input_path', help="file of image urls, or '-' for stdin")
+    parser.add_argument('memcache_endpoint', help='host[:port], comma separated to shard across several servers')
+    parser.add_argument('min_prob', type=float)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--inference-mode', choices=INFERENCE_MODES, default=FROZEN_MODE)
+    add_model_arguments(parser)
+    args = parser.parse_args()
+
+    config = DEFAULT_EXECUTION_CONFIG._replace(model_reload_interval=args.model_reload_interval)
+
+    run_worker([FileSource(args.input_path, args.batch_size)], args.memcache_endpoint, args.min_prob, 1, config,
+               preload_models(args.inference_mode, args.model))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,101 +1,167 @@
-from kafka import KafkaConsumer
-from ImageClassifier import CustomImageClassifier
-import multiprocessing
-from pymemcache.client.base import Client
-import sys
+from kafka import ConsumerRebalanceListener, KafkaConsumer
+from kafka.errors import KafkaError
+from kafka.structs import OffsetAndMetadata
+from ClassificationPipeline import MessageSource, run_worker, supervise, preload_models, add_execution_arguments, \
+    execution_config
+from Metrics import SharedMetrics, serve_metrics
+import argparse
 import logging
-import hashlib
-from time import sleep
+from collections import deque
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def kafka_polling(kafka_topic, kafka_group_id, kafka_host, memcache_endpoint, min_prob, process_id):
+# records fetched per poll and classified as one batch
+MAX_POLL_RECORDS = 32
+POLL_TIMEOUT_MS = 1000
+
+
+class KafkaSource(MessageSource, ConsumerRebalanceListener):
     '''
-    Poll kafka topic - for each message received get image classification and persist result to memcache
+    Poll based consumer that hands out record batches and commits offsets manually once results are persisted. A
+    failed commit is logged and never fails the worker - a later commit covers its records, or they are consumed
+    again after a restart or rebalance.
     '''
 
-    logger.warning("Process %d: Beginning to poll Kafka" % process_id)
+    def __init__(self, kafka_topic, kafka_group_id, kafka_host, process_id, max_records=MAX_POLL_RECORDS):
+        self.process_id = process_id
+        self.max_records = max_records
+        self.consumer = KafkaConsumer(group_id=kafka_group_id, bootstrap_servers=[kafka_host],
+                                      enable_auto_commit=False, max_poll_records=max_records)
+        self.consumer.subscribe([kafka_topic], listener=self)
+
+        # per partition, [batch, lowest offset, highest offset, done] in poll order - inference threads can finish
+        # batches out of order, but a partition is only committed up to its oldest batch that is not done yet
+        self.in_flight = {}
+
+    def on_partitions_revoked(self, revoked):
+        # commit what is already done while the partitions are still ours, batches still in flight for them are
+        # redone by the new owner
+        self._commit_done()
+        for tp in revoked:
+            self.in_flight.pop(tp, None)
+        logger.warning('Process %d: partitions revoked: %s' % (self.process_id, sorted(revoked)))
+
+    def on_partitions_assigned(self, assigned):
+        logger.warning('Process %d: partitions assigned: %s' % (self.process_id, sorted(assigned)))
+
+    def receive_batches(self):
+        '''
+        Yield batches of up to max_records records across all assigned partitions forever
+        '''
+        while 1:
+            records = self.consumer.poll(timeout_ms=POLL_TIMEOUT_MS, max_records=self.max_records)
+            batch = [record for partition_records in records.values() for record in partition_records]
+
+            for tp, partition_records in records.items():
+                if partition_records:
+                    offsets = [record.offset for record in partition_records]
+                    self.in_flight.setdefault(tp, deque()).append([batch, min(offsets), max(offsets), False])
+
+            yield batch
+
+    def get_url(self, message):
+        return message.value.decode('utf-8')
+
+    def sent_at(self, message):
+        # record timestamps are epoch milliseconds, negative when the producer did not set one
+        return message.timestamp / 1000.0 if message.timestamp is not None and message.timestamp >= 0 else None
+
+    def ack(self, messages):
+        '''
+        Commit the offset after the last record of each partition that is still assigned to this consumer, once
+        every batch polled before this one is done too
+        '''
+        for entries in self.in_flight.values():
+            for entry in entries:
+                if entry[0] is messages:
+                    entry[3] = True
+
+        self._commit_done()
+
+    def _commit_done(self):
+        offsets = {}
+        for tp, entries in self.in_flight.items():
+            while entries and entries[0][3]:
+                offsets[tp] = entries.popleft()[2] + 1
+
+        assigned = self.consumer.assignment()
+        offsets = dict((tp, OffsetAndMetadata(offset, None)) for tp, offset in offsets.items() if tp in assigned)
+
+        if not offsets:
+            return
 
-    logger.warning(
-        "Process %d: Beginning to poll Kafka. Topic: %s, groupid: %s, host: %s" % (process_id, kafka_topic, kafka_group_id, kafka_host))
+        try:
+            self.consumer.commit(offsets)
+        except KafkaError:
+            logger.error('Process %d: failed to commit offsets %s' % (self.process_id, offsets), exc_info=True)
 
-    # Kafka client config
-    consumer = KafkaConsumer(kafka_topic, group_id=kafka_group_id, bootstrap_servers=[kafka_host])
+    def nack(self, messages):
+        '''
+        Seek back to the first record of each partition so a batch whose results were not persisted is redone.
+        The partitions are not committed past that record until the batch polled again is done.
+        '''
+        assigned = self.consumer.assignment()
 
-    # Memcache config
-    memcache_client = Client((memcache_endpoint, 11211))
+        for tp, entries in self.in_flight.items():
+            failed = [i for i, entry in enumerate(entries) if entry[0] is messages]
+            if not failed:
+                # already dropped by the nack of an earlier batch, whose seek polls these records again too
+                continue
 
-    # create image matcher object. This loads Inception model in memory.
-    image_clf = CustomImageClassifier()
+            # the seek polls this batch and everything after it on the partition again, so those batches are
+            # forgotten - their acks no longer commit anything
+            offset = entries[failed[0]][1]
+            self.in_flight[tp] = deque(list(entries)[:failed[0]])
 
-    for message in consumer:
+            if tp in assigned:
+                self.consumer.seek(tp, offset)
 
-        image_url = message.value.decode('utf-8')
+        self._commit_done()
 
-        logger.warning('Process %d: Received image url %s' % (process_id, image_url))
+    def close(self):
+        self.consumer.close(autocommit=False)
 
-        # predict image category and persist to memcache
-        try:
-            image_pred = image_clf.run_inference_on_image(image_url)
 
-            logger.warning('%s | %s |%s' % (image_url, image_pred[0], str(image_pred[1])))
+def kafka_polling(kafka_topic, kafka_group_id, kafka_host, memcache_endpoint, min_prob, config, models, metrics,
+                  process_id):
+    '''
+    Poll kafka topic - for each batch of records get image classifications and persist results to memcache
+    '''
+
+    logger.warning(
+        "Process %d: Beginning to poll Kafka. Topic: %s, groupid: %s, host: %s" % (process_id, kafka_topic, kafka_group_id, kafka_host))
 
-            # write prediction to memcached if we are confident enough
-            if image_pred[1] > min_prob:
-                memcache_client.set('%s' % hashlib.md5(image_url).hexdigest(), image_pred[0])
-            else:
-                memcache_client.set('%s' % hashlib.md5(image_url).hexdigest(), "prediction below threshold")
+    # Kafka client config - partitions are balanced across every consumer of every worker in the consumer group
+    sources = [KafkaSource(kafka_topic, kafka_group_id, kafka_host, process_id) for _ in range(config.num_sources)]
 
-        except Exception:
-            logger.error("Process %d: Failed to write to memcached" % process_id, exc_info=True)
-            memcache_client.set('%s' % hashlib.md5(image_url).hexdigest(), "prediction error")
+    run_worker(sources, memcache_endpoint, min_prob, process_id, config, models, metrics)
 
 
 def main():
-    kafka_topic = sys.argv[1]
-    kafka_host = sys.argv[2]
-    kafka_group_id = sys.argv[3]
-    memcache_endpoint = sys.argv[4]
-    min_prob = float(sys.argv[5])
-
-    # keep track of processes in dictionary to restart if needed i.e. {PID: Process}
-    processes = {}
-
-    num_processes = range(1, 9)
-
-    for p_num in num_processes:
-        p = multiprocessing.Process(
-            target=kafka_polling, args=(kafka_topic, kafka_group_id, kafka_host, memcache_endpoint, min_prob, p_num,))
-        p.start()
-        processes[p_num] = p
-
-    # periodically poll child processes to check if they are still alive
-    while len(processes) > 0:
-
-        # check every 5 minutes
-        sleep(300.0)
-
-        for n in processes.keys():
-            p = processes[n]
-
-            # if process is dead, create a new one to take its place
-            if not p.is_alive():
-                logger.error('Process %d is dead! Starting new process to take its place.' % n)
-                replacement_p = multiprocessing.Process(target=kafka_polling,
-                                                        args=(
-                                                            kafka_topic, kafka_group_id, kafka_host, memcache_endpoint,
-                                                            min_prob, n,))
-                replacement_p.start()
-                processes[n] = replacement_p
-
-            elif p.is_alive():
-                logger.warning('Process %d is still alive' % n)
-
-            # since polling never ends, sqs_polling should never successfully exit but we add this for completeness
-            elif p.exitcode == 0:
-                p.join()
+    parser = argparse.ArgumentParser(description='Classify image urls read from a Kafka topic')
+    parser.add_argument('kafka_topic')
+    parser.add_argument('kafka_host')
+    parser.add_argument('kafka_group_id')
+    parser.add_argument('memcache_endpoint', help='host[:port], comma separated to shard across several servers')
+    parser.add_argument('min_prob', type=float)
+    add_execution_arguments(parser)
+    args = parser.parse_args()
+
+    num_workers, config = execution_config(args)
+
+    # parsed once here and inherited by every (re)started worker
+    models = preload_models(args.inference_mode, args.model)
+
+    # workers add to their own row of shared memory, the supervisor sums the rows when scraped
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = SharedMetrics(num_workers)
+        serve_metrics(metrics, args.metrics_port)
+
+    supervise(kafka_polling, (args.kafka_topic, args.kafka_group_id, args.kafka_host, args.memcache_endpoint,
+                              args.min_prob, config, models, metrics), num_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,671 @@
+import logging
+import multiprocessing
+import random
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from time import sleep, time
+
+import numpy as np
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+from BatchScheduler import AdaptiveBatchScheduler
+from ImageClassifier import CustomImageClassifier, INFERENCE_MODES, FROZEN_MODE, load_model
+from ImageFetcher import ImageFetcher
+from ModelRegistry import ModelRegistry, DEFAULT_MODEL, model_source
+from ResultCache import ResultCache, create_memcache_client, url_key, content_key, model_key, ERROR_VALUE
+
+logger = logging.getLogger(__name__)
+
+BELOW_THRESHOLD_VALUE = "prediction below threshold"
+
+DEFAULT_NUM_WORKERS = 8
+
+# fraction of batches whose per-image results are logged at debug level
+DEBUG_LOG_SAMPLE_RATE = 0.01
+
+# batches buffered between two stages before the upstream stage blocks
+DEFAULT_QUEUE_SIZE = 4
+
+# 'process' runs one full model per worker process, 'shared' runs one model process fed by many I/O threads
+PROCESS_MODE = 'process'
+SHARED_MODE = 'shared'
+
+# how a worker process splits its work - sources (each with a fetch thread), inference threads sharing one
+# TensorFlow session, and the TensorFlow thread pools of that session - and, if max_batch_size is set, the bounds of
+# the adaptive scheduler coalescing source batches into forward passes (see BatchScheduler.py), and how often model
+# files are checked for changes to reload (never if None)
+ExecutionConfig = namedtuple('ExecutionConfig',
+                             ['num_sources', 'inference_threads', 'intra_op_threads', 'inter_op_threads',
+                              'max_batch_size', 'max_batch_wait', 'latency_target', 'model_reload_interval'])
+
+DEFAULT_EXECUTION_CONFIG = ExecutionConfig(num_sources=1, inference_threads=1, intra_op_threads=None,
+                                           inter_op_threads=None, max_batch_size=None, max_batch_wait=None,
+                                           latency_target=None, model_reload_interval=None)
+
+
+def add_execution_arguments(parser):
+    parser.add_argument('--mode', choices=[PROCESS_MODE, SHARED_MODE], default=PROCESS_MODE,
+                        help="'process': --workers processes with a model each, "
+                             "'shared': one model process fed by --io-workers consumers")
+    parser.add_argument('--workers', type=int, default=DEFAULT_NUM_WORKERS, help='worker processes in process mode')
+    parser.add_argument('--io-workers', type=int, default=DEFAULT_NUM_WORKERS,
+                        help='queue consumers feeding the shared model in shared mode')
+    parser.add_argument('--inference-threads', type=int, default=1,
+                        help='threads running batches through the shared model in shared mode')
+    parser.add_argument('--inference-mode', choices=INFERENCE_MODES, default=FROZEN_MODE,
+                        help='load the graph as trained, or the optimized / quantized graph written by '
+                             'GraphOptimizer.py')
+    parser.add_argument('--max-batch-size', type=int, default=None,
+                        help='coalesce queued batches into forward passes of up to this many images, with the '
+                             'limit tuned down to meet --p99-target-ms')
+    parser.add_argument('--max-batch-wait-ms', type=float, default=50.0,
+                        help='longest wait for more images before an under-full forward pass')
+    parser.add_argument('--p99-target-ms', type=float, default=2000.0,
+                        help='p99 latency from a message being read to it being classified')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve worker metrics for Prometheus on http://127.0.0.1:PORT/metrics')
+    add_model_arguments(parser)
+
+
+def add_model_arguments(parser):
+    parser.add_argument('--model', action='append', default=[], type=parse_model_argument,
+                        metavar='NAME=GRAPH,LABELS',
+                        help='also classify with this retrained graph and label file, results are stored under '
+                             'NAME_<key>. Can be repeated.')
+    parser.add_argument('--model-reload-interval', type=float, default=60.0,
+                        help='seconds between checks for changed model files, which are then reloaded without '
+                             'a restart (0 to never reload)')
+
+
+def parse_model_argument(value):
+    '''
+    'NAME=GRAPH,LABELS' -> (name, graph path, labels path)
+    '''
+    name, _, paths = value.partition('=')
+    model_path, _, labels_path = paths.partition(',')
+
+    if not name or not model_path or not labels_path or name == DEFAULT_MODEL:
+        raise ValueError("Expected NAME=GRAPH,LABELS with NAME other than %s, got %s" % (DEFAULT_MODEL, value))
+
+    return name, model_path, labels_path
+
+
+def execution_config(args, num_cores=None):
+    '''
+    Returns (number of worker processes, ExecutionConfig for each of them) with TensorFlow thread pools sized so
+    that all workers together use each core once
+    '''
+    num_cores = num_cores or multiprocessing.cpu_count()
+
+    batching = dict(max_batch_size=args.max_batch_size,
+                    max_batch_wait=args.max_batch_wait_ms / 1000.0,
+                    latency_target=args.p99_target_ms / 1000.0,
+                    model_reload_interval=args.model_reload_interval or None)
+
+    if args.mode == SHARED_MODE:
+        return 1, ExecutionConfig(num_sources=args.io_workers,
+                                  inference_threads=args.inference_threads,
+                                  intra_op_threads=max(1, num_cores // args.inference_threads),
+                                  inter_op_threads=args.inference_threads,
+                                  **batching)
+
+    return args.workers, ExecutionConfig(num_sources=1,
+                                         inference_threads=1,
+                                         intra_op_threads=max(1, num_cores // args.workers),
+                                         inter_op_threads=1,
+                                         **batching)
+
+
+def result_key(model_name, key):
+    '''
+    Key a model's result for a url_key or content_key is stored under - the plain key for the default model
+    '''
+    return key if model_name == DEFAULT_MODEL else model_key(model_name, key)
+
+
+class MessageSource(object):
+    '''
+    Pipeline input - yields batches of messages carrying image urls and acknowledges them once their
+    results are persisted. receive_batches, ack and nack are always called from the same thread, unless
+    thread_safe_ack is set - then ack and nack are called from the sink as soon as a batch is written.
+    '''
+
+    thread_safe_ack = False
+
+    def receive_batches(self):
+        '''
+        Yield lists of messages, empty lists are allowed while the source is idle
+        '''
+        raise NotImplementedError
+
+    def get_url(self, message):
+        raise NotImplementedError
+
+    def sent_at(self, message):
+        '''
+        Epoch seconds the message was put on the queue, or None if the source does not know
+        '''
+        return None
+
+    def ack(self, messages):
+        '''
+        Results for messages are persisted
+        '''
+        pass
+
+    def nack(self, messages):
+        '''
+        Results for messages could not be persisted
+        '''
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSource(MessageSource):
+    '''
+    Reads image urls one per line from a local file, or stdin for '-'
+    '''
+
+    def __init__(self, path, batch_size=10):
+        self.path = path
+        self.batch_size = batch_size
+
+    def receive_batches(self):
+        f = sys.stdin if self.path == '-' else open(self.path, 'r')
+
+        try:
+            batch = []
+            for line in f:
+                url = line.strip()
+                if not url:
+                    continue
+                batch.append(url)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def get_url(self, message):
+        return message
+
+    def nack(self, messages):
+        logger.error("Failed to persist results for %d urls: %s" % (len(messages), messages))
+
+
+class StageObserver(object):
+    '''
+    Receives the wall time of every pipeline stage run - fetch, decode, inference, cache_write and ack per batch,
+    end_to_end from a batch being read to it being acked, and queue_lag per message - along with per-image counts.
+    Called from the stage threads.
+    '''
+
+    def observe(self, stage, seconds, num_images):
+        pass
+
+    def increment(self, counter, n=1):
+        '''
+        counter is one of messages_received, images_classified, below_threshold, errors, cache_hits, cache_misses
+        '''
+        pass
+
+
+class ImageError(Exception):
+    '''
+    An image could not be downloaded or decoded
+    '''
+    pass
+
+
+class Batch(object):
+    '''
+    A batch of messages and everything the stages have worked out about them so far
+    '''
+
+    def __init__(self, source_index, messages, urls, models, cached):
+        self.source_index = source_index
+        self.messages = messages
+        self.urls = urls
+        self.models = models
+        self.cached = cached
+        self.received_at = time()
+        self.fetched = None
+        self.fetch_seconds = 0.0
+        self.content_keys = None
+        self.content_hits = None
+        self.tensors = None
+        self.writes = {}
+
+
+class ClassificationPipeline(object):
+    '''
+    source -> fetch -> decode -> batch inference + threshold -> memcache sink, each stage on its own threads with
+    bounded queues in between, so the slowest stage applies backpressure all the way back to the sources.
+    Several sources can feed one ModelRegistry, whose models are shared by all inference threads. Images are
+    decoded once and classified by every model of the registry - the first one's results are stored under the url
+    and content keys, the others' under model_key(name, key). An image is only skipped once every model's result
+    for it is cached.
+    '''
+
+    def __init__(self, sources, image_clf, result_cache, fetcher, min_prob, process_id,
+                 queue_size=DEFAULT_QUEUE_SIZE, inference_threads=1, observer=None, scheduler=None):
+        self.sources = sources
+        self.image_clf = image_clf
+        self.result_cache = result_cache
+        self.fetcher = fetcher
+        self.min_prob = min_prob
+        self.process_id = process_id
+        self.inference_threads = inference_threads
+        self.observer = observer or StageObserver()
+        self.scheduler = scheduler
+
+        self.fetch_queue = Queue(queue_size)
+        self.decode_queue = Queue(queue_size)
+
+        # with a scheduler, room for a batch from every source so they can be coalesced into one forward pass
+        self.inference_queue = Queue(max(queue_size, len(sources)) if scheduler is not None else queue_size)
+        self.sink_queue = Queue(queue_size)
+
+        # acks are applied on each source's own thread because e.g. Kafka consumers are not thread safe, sources
+        # with thread_safe_ack are acked right away by the sink instead
+        self.ack_queues = [Queue() for _ in sources]
+
+        self.failed = threading.Event()
+
+    def run(self):
+        '''
+        Run until every source is exhausted, raises if any stage fails
+        '''
+        stages = [(self._run_stage, self._fetch, self.fetch_queue, self.decode_queue, len(self.sources)),
+                  (self._run_stage, self._decode, self.decode_queue, self.inference_queue, self.inference_threads),
+                  (self._run_inference, self._infer, self.inference_queue, self.sink_queue, self.inference_threads),
+                  (self._run_stage, self._sink, self.sink_queue, None, 1)]
+
+        for runner, stage, inbox, outbox, num_threads in stages:
+            for _ in range(num_threads):
+                self._start_thread(runner, stage, inbox, outbox)
+
+        readers = [self._start_thread(self._read_source, i) for i in range(len(self.sources))]
+
+        try:
+            for t in readers:
+                while t.is_alive():
+                    self._check_failed()
+                    t.join(1.0)
+
+            # every batch is handed downstream before it is marked done, so draining the queues in order
+            # means every batch has been persisted
+            for _, _, inbox, _, _ in stages:
+                while inbox.unfinished_tasks:
+                    self._check_failed()
+                    sleep(0.1)
+
+            self._check_failed()
+
+            for i in range(len(self.sources)):
+                self._apply_acks(i)
+        finally:
+            for source in self.sources:
+                source.close()
+
+    def _start_thread(self, target, *args):
+        t = threading.Thread(target=self._guard, args=(target,) + args)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except Exception:
+            logger.error("Process %d: pipeline thread %s failed" % (self.process_id, target.__name__), exc_info=True)
+            self.failed.set()
+
+    def _check_failed(self):
+        if self.failed.is_set():
+            raise RuntimeError("Process %d: pipeline stage failed" % self.process_id)
+
+    def _put(self, queue, item):
+        # blocks while the queue is full, but gives up if another stage has died
+        while 1:
+            self._check_failed()
+            try:
+                queue.put(item, timeout=1.0)
+                return
+            except Full:
+                pass
+
+    def _run_stage(self, stage, inbox, outbox):
+        while 1:
+            batch = inbox.get()
+            stage(batch)
+
+            if outbox is not None:
+                self._put(outbox, batch)
+
+            inbox.task_done()
+
+    def _run_inference(self, stage, inbox, outbox):
+        while 1:
+            # without a scheduler every source batch is a forward pass of its own
+            batches = self.scheduler.collect(inbox) if self.scheduler is not None else [inbox.get()]
+            inference_seconds = stage(batches)
+
+            if self.scheduler is not None:
+                self.scheduler.record(batches, inference_seconds, inbox.qsize())
+
+            for batch in batches:
+                self._put(outbox, batch)
+                inbox.task_done()
+
+    def _apply_acks(self, source_index):
+        source = self.sources[source_index]
+
+        while 1:
+            try:
+                batch, persisted = self.ack_queues[source_index].get_nowait()
+            except Empty:
+                return
+
+            self._acknowledge(source, batch, persisted)
+
+    def _acknowledge(self, source, batch, persisted):
+        ack_start = time()
+        if persisted:
+            source.ack(batch.messages)
+        else:
+            source.nack(batch.messages)
+
+        now = time()
+        self.observer.observe('ack', now - ack_start, len(batch.messages))
+        self.observer.observe('end_to_end', now - batch.received_at, len(batch.messages))
+
+    def _read_source(self, source_index):
+        source = self.sources[source_index]
+
+        for messages in source.receive_batches():
+            self._apply_acks(source_index)
+            self._check_failed()
+
+            if not messages:
+                continue
+
+            self.observer.increment('messages_received', len(messages))
+
+            now = time()
+            for m in messages:
+                sent_at = source.sent_at(m)
+                if sent_at is not None:
+                    self.observer.observe('queue_lag', max(0.0, now - sent_at), 1)
+
+            # urls with a cached result of every model are never downloaded
+            urls = [source.get_url(m) for m in messages]
+            models = self.image_clf.names()
+            cached = self._cached_results([url_key(url) for url in urls], models)
+
+            self._put(self.fetch_queue, Batch(source_index, messages, urls, models, cached))
+
+    def _cached_results(self, keys, models):
+        '''
+        For each of keys (None for no key), a dict of model name -> cached result, or None unless the result of every
+        one of models is cached
+        '''
+        model_keys = [[result_key(name, key) for name in models] if key is not None else None for key in keys]
+        found = self.result_cache.get_many([k for ks in model_keys if ks is not None for k in ks])
+
+        return [dict((name, found[k]) for name, k in zip(models, ks))
+                if ks is not None and all(k in found for k in ks) else None
+                for ks in model_keys]
+
+    def _fetch(self, batch):
+        batch.fetched, batch.fetch_seconds = self.fetcher.fetch_many(
+            [url if cached is None else None for url, cached in zip(batch.urls, batch.cached)])
+        self.observer.observe('fetch', batch.fetch_seconds, len([f for f in batch.fetched if f is not None]))
+
+        # same image bytes behind a different url - reuse the result stored under the content hash
+        batch.content_keys = [content_key(f.data) if f is not None and f.error is None else None
+                              for f in batch.fetched]
+        batch.content_hits = self._cached_results(batch.content_keys, batch.models)
+
+    def _decode(self, batch):
+        decode_start = time()
+        batch.tensors = self.image_clf.preprocess_batch(
+            [f.data for f, k, hit in zip(batch.fetched, batch.content_keys, batch.content_hits)
+             if k is not None and hit is None])
+        self.observer.observe('decode', time() - decode_start, len(batch.tensors))
+
+    def _infer(self, batches):
+        '''
+        Classify the remaining images of one or more batches in one forward pass, returns its duration
+        '''
+        tensors = [t for batch in batches for t in batch.tensors]
+
+        # threshold the whole forward pass of every model as one array mask
+        inference_start = time()
+        preds = [None] * len(tensors)
+        if tensors:
+            model_predictions = self.image_clf.postprocess_all(tensors, 1, self.min_prob)
+            for n, (model_name, predictions) in enumerate(model_predictions.items()):
+                results = np.where(predictions.confident, predictions.labels[:, 0], BELOW_THRESHOLD_VALUE)
+                for row, i in enumerate(predictions.rows):
+                    if n == 0:
+                        preds[i] = (results[row], predictions.scores[row, 0], {})
+                    else:
+                        preds[i][2][model_name] = results[row]
+        inference_seconds = time() - inference_start
+        self.observer.observe('inference', inference_seconds, len(tensors))
+
+        preds = iter(preds)
+        for batch in batches:
+            # per-image logging is sampled, so it costs next to nothing unless debug logging is on
+            log_batch = logger.isEnabledFor(logging.DEBUG) and random.random() < DEBUG_LOG_SAMPLE_RATE
+
+            if log_batch:
+                logger.debug('Process %d: fetched %d images in %.3fs, inference on %d of %d images in %.3fs'
+                             % (self.process_id, len([f for f in batch.fetched if f is not None]),
+                                batch.fetch_seconds, len(batch.tensors), len(tensors), inference_seconds))
+                logger.debug('Process %d: cache %s' % (self.process_id, self.result_cache.stats()))
+
+            batch.writes = self._results(batch, preds, log_batch)
+
+        return inference_seconds
+
+    def _results(self, batch, preds, log_batch=False):
+        '''
+        Collect the memcache writes for a classified batch, preds holds a thresholded (result, score, results of the
+        other models by name) per tensor
+        '''
+        writes = {}
+        counts = dict.fromkeys(['images_classified', 'below_threshold', 'errors', 'cache_hits', 'cache_misses'], 0)
+
+        primary = batch.models[0]
+
+        for image_url, cached, fetch_result, image_key, content_hit in zip(batch.urls, batch.cached, batch.fetched,
+                                                                           batch.content_keys, batch.content_hits):
+            try:
+                # already classified by every model under this url
+                if cached is not None:
+                    counts['cache_hits'] += 1
+                    if log_batch:
+                        logger.debug('%s | %s (cached)' % (image_url, cached[primary]))
+                    continue
+
+                if fetch_result.error is not None:
+                    raise ImageError("Could not fetch image: %s" % fetch_result.error)
+
+                if content_hit is not None:
+                    counts['cache_hits'] += 1
+                    if log_batch:
+                        logger.debug('%s | %s (cached image)' % (image_url, content_hit[primary]))
+                    for model_name, model_result in content_hit.items():
+                        writes[result_key(model_name, url_key(image_url))] = model_result
+                    continue
+
+                counts['cache_misses'] += 1
+
+                image_pred = next(preds)
+                if image_pred is None:
+                    raise ImageError("Could not decode image")
+
+                if log_batch:
+                    logger.debug('%s | %s |%s' % (image_url, image_pred[0], str(image_pred[1])))
+
+                # the label if we are confident enough, BELOW_THRESHOLD_VALUE otherwise
+                result = image_pred[0]
+
+                counts['images_classified'] += 1
+                if result == BELOW_THRESHOLD_VALUE:
+                    counts['below_threshold'] += 1
+
+                writes[url_key(image_url)] = result
+                writes[image_key] = result
+
+                for model_name, model_result in image_pred[2].items():
+                    writes[model_key(model_name, url_key(image_url))] = model_result
+                    writes[model_key(model_name, image_key)] = model_result
+
+            except Exception as e:
+                # unreachable and bad images are expected, they are counted and only logged with the sampled batches
+                if isinstance(e, ImageError):
+                    if log_batch:
+                        logger.debug('%s | %s' % (image_url, e))
+                else:
+                    logger.error("Process %d: Failed to classify image" % self.process_id, exc_info=True)
+
+                counts['errors'] += 1
+                for model_name in batch.models:
+                    writes[result_key(model_name, url_key(image_url))] = ERROR_VALUE
+
+        for counter, n in counts.items():
+            if n:
+                self.observer.increment(counter, n)
+
+        return writes
+
+    def _sink(self, batch):
+        # results for the whole batch are written to memcache in one round trip
+        write_start = time()
+        failed = self.result_cache.set_many(batch.writes)
+        self.observer.observe('cache_write', time() - write_start, len(batch.writes))
+
+        source = self.sources[batch.source_index]
+        if source.thread_safe_ack:
+            self._acknowledge(source, batch, not failed)
+        else:
+            self.ack_queues[batch.source_index].put((batch, not failed))
+
+
+def run_worker(sources, memcache_endpoint, min_prob, process_id, config=DEFAULT_EXECUTION_CONFIG, models=None,
+               metrics=None):
+    '''
+    Classify every image url from sources and persist the results to memcache, with the models shared by all sources.
+    models is the supervisor's preload_models() result, inherited copy-on-write when forked, and metrics the
+    supervisor's Metrics.SharedMetrics if it serves them.
+    '''
+    start = time()
+
+    # Memcache config - comma separated endpoints are sharded over by a pooled hash client
+    memcache_client = create_memcache_client(memcache_endpoint)
+
+    # create the models once for every source of this process, each is warmed up before taking traffic
+    image_clf = ModelRegistry(config.intra_op_threads, config.inter_op_threads)
+    warm_up_seconds = sum(image_clf.add(name, preloaded, source)
+                          for name, (source, preloaded) in (models or preload_models()).items())
+
+    if config.model_reload_interval:
+        image_clf.watch(config.model_reload_interval)
+
+    logger.warning("Process %d: cold start took %.2fs (loading and warming up models %.2fs)"
+                   % (process_id, time() - start, warm_up_seconds))
+
+    # enough download threads and pooled connections for every source's batches to be in flight at once
+    fetcher = ImageFetcher(num_threads=max(16, 4 * len(sources)))
+
+    scheduler = None
+    if config.max_batch_size:
+        scheduler = AdaptiveBatchScheduler(config.max_batch_size, config.max_batch_wait, config.latency_target)
+
+    pipeline = ClassificationPipeline(sources, image_clf, ResultCache(memcache_client), fetcher, min_prob,
+                                      process_id, inference_threads=config.inference_threads,
+                                      observer=metrics.worker(process_id) if metrics is not None else None,
+                                      scheduler=scheduler)
+
+    try:
+        pipeline.run()
+    finally:
+        image_clf.close()
+        fetcher.close()
+
+
+def preload_model(mode=FROZEN_MODE):
+    '''
+    Parse the model and labels once in the supervisor so forked workers start warm
+    '''
+    start = time()
+    preloaded = CustomImageClassifier.preload(mode)
+    logger.warning("Loaded %s model in %.2fs" % (mode, time() - start))
+    return preloaded
+
+
+def preload_models(mode=FROZEN_MODE, extra_models=()):
+    '''
+    Parse the default model and every (name, graph path, labels path) of extra_models once in the supervisor.
+    Returns an OrderedDict of name -> (ModelSource, PreloadedModel), default model first.
+    '''
+    models = OrderedDict()
+    models[DEFAULT_MODEL] = (model_source(CustomImageClassifier.modelFullPath, CustomImageClassifier.labelsFullPath,
+                                          mode), preload_model(mode))
+
+    for name, model_path, labels_path in extra_models:
+        start = time()
+        models[name] = (model_source(model_path, labels_path, mode), load_model(model_path, labels_path, mode))
+        logger.warning("Loaded %s model %s in %.2fs" % (mode, name, time() - start))
+
+    return models
+
+
+def supervise(target, args, num_workers=DEFAULT_NUM_WORKERS):
+    '''
+    Run num_workers processes of target(*args, process_id) and replace any that die. Workers are forked, so
+    anything loaded before calling supervise (see preload_model) is shared with them copy-on-write.
+    '''
+    # keep track of processes in dictionary to restart if needed i.e. {PID: Process}
+    processes = {}
+
+    for p_num in range(1, num_workers + 1):
+        p = multiprocessing.Process(target=target, args=args + (p_num,))
+        p.start()
+        processes[p_num] = p
+
+    # periodically poll child processes to check if they are still alive
+    while len(processes) > 0:
+
+        # check every 5 minutes
+        sleep(300.0)
+
+        for n in processes.keys():
+            p = processes[n]
+
+            # if process is dead, create a new one to take its place
+            if not p.is_alive():
+                logger.error('Process %d is dead! Starting new process to take its place.' % n)
+                replacement_p = multiprocessing.Process(target=target, args=args + (n,))
+                replacement_p.start()
+                processes[n] = replacement_p
+
+            elif p.is_alive():
+                logger.debug('Process %d is still alive' % n)
+
+            # since polling never ends, workers should never successfully exit but we add this for completeness
+            elif p.exitcode == 0:
+                p.join()
@@ -1,120 +1,213 @@
 import boto3
-from ImageClassifier import CustomImageClassifier
-import multiprocessing
-from pymemcache.client.base import Client
-import sys
+from botocore.exceptions import BotoCoreError, ClientError
+from ClassificationPipeline import MessageSource, run_worker, supervise, preload_models, add_execution_arguments, \
+    execution_config
+from Metrics import SharedMetrics, serve_metrics
+import argparse
+import os
 import logging
-import hashlib
-from time import sleep
+import threading
+from time import sleep, time
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def sqs_polling(queue_name, memcache_endpoint, min_prob, process_id):
-    '''
-    Poll SQS queue - for each message received get image classification and persist result to memcache
-    '''
+# messages stay invisible to other workers for this long after being received
+VISIBILITY_TIMEOUT = 60
 
-    logger.warning("Process %d: Beginning to poll SQS" % process_id)
+# idle backoff doubles from MIN_IDLE_SLEEP up to MAX_IDLE_SLEEP seconds while the queue stays empty - capped at the
+# long poll wait, so a message sent to an idle queue waits at most about 40 seconds
+MIN_IDLE_SLEEP = 1.0
+MAX_IDLE_SLEEP = 20.0
 
-    # SQS client config
-    sqs = boto3.resource('sqs', region_name='us-east-1')
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
+# most entries a single SQS batch call accepts
+MAX_BATCH_ENTRIES = 10
 
-    # Memcache config
-    memcache_client = Client((memcache_endpoint, 11211))
 
-    # create image matcher object. This loads Inception model in memory.
-    image_clf = CustomImageClassifier()
-
-    no_messages = False
+class SQSSource(MessageSource):
+    '''
+    Batch receive, visibility extension and batch acknowledgement for one SQS queue. Transport errors are logged and
+    never fail the worker - a message that is not deleted is received again after its visibility timeout.
+    '''
 
-    # poll sqs forever
-    while 1:
+    # deletes go through the thread safe low level client, so batches are acked as soon as they are written
+    thread_safe_ack = True
+
+    def __init__(self, queue_name, process_id, visibility_timeout=VISIBILITY_TIMEOUT):
+        # SQS client config - SQS_ENDPOINT_URL points at a local stand-in such as ElasticMQ or moto server
+        sqs = boto3.resource('sqs', region_name='us-east-1', endpoint_url=os.environ.get('SQS_ENDPOINT_URL'))
+        self.queue = sqs.get_queue_by_name(QueueName=queue_name)
+
+        # the low level client is thread safe, visibility is extended from a background thread
+        self.client = sqs.meta.client
+
+        self.process_id = process_id
+        self.visibility_timeout = visibility_timeout
+
+        # message id -> (message, time its visibility was last set) for every message not acked or nacked yet, so
+        # batches are kept invisible wherever they are held up in the pipeline
+        self.received_at = {}
+        self.received_at_lock = threading.Lock()
+
+        self.closed = threading.Event()
+        self.keep_alive_thread = threading.Thread(target=self._keep_alive)
+        self.keep_alive_thread.daemon = True
+        self.keep_alive_thread.start()
+
+    def queue_depth(self):
+        '''
+        Approximate number of visible messages, or None if the queue attributes could not be read
+        '''
+        try:
+            self.queue.reload()
+        except (BotoCoreError, ClientError):
+            logger.error('Process %d: failed to read the queue depth' % self.process_id, exc_info=True)
+            return None
+        return int(self.queue.attributes.get('ApproximateNumberOfMessages', 0))
+
+    def receive_batches(self):
+        '''
+        Yield message batches (up to 10 at a time) from the SQS queue forever, backing off while it is empty
+        '''
+        idle_sleep = 0.0
+
+        while 1:
+
+            # back off exponentially while the queue is empty (or unreachable), but resume as soon as it reports
+            # messages
+            if idle_sleep > 0 and not self.queue_depth():
+                logger.warning('Process %d: no messages received so sleeping for %.0f seconds'
+                               % (self.process_id, idle_sleep))
+                sleep(idle_sleep)
+
+            # get next batch of messages (up to 10 at a time), a failed receive backs off like an empty one
+            try:
+                message_batch = self.queue.receive_messages(MaxNumberOfMessages=MAX_BATCH_ENTRIES, WaitTimeSeconds=20,
+                                                            VisibilityTimeout=self.visibility_timeout,
+                                                            AttributeNames=['SentTimestamp'])
+            except (BotoCoreError, ClientError):
+                logger.error('Process %d: failed to receive messages' % self.process_id, exc_info=True)
+                message_batch = []
 
-        # sleep longer if there are no messages on the queue the last time it was polled
-        if no_messages:
-            logger.warning('Process %d: no messages received so sleeping for 15 minutes' % process_id)
-            sleep(900.0)
-            queue = sqs.get_queue_by_name(QueueName=queue_name)
+            logger.debug('Process %d: received %d messages' % (self.process_id, len(message_batch)))
 
-        # get next batch of messages (up to 10 at a time)
-        message_batch = queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=20)
+            if message_batch:
+                idle_sleep = 0.0
+            else:
+                idle_sleep = min(max(idle_sleep * 2, MIN_IDLE_SLEEP), MAX_IDLE_SLEEP)
 
-        logger.warning('Process %d: received %d messages' % (process_id, len(message_batch)))
+            now = time()
+            with self.received_at_lock:
+                for message in message_batch:
+                    self.received_at[message.message_id] = (message, now)
 
-        if len(message_batch) == 0:
-            no_messages = True
-        else:
-            no_messages = False
+            yield message_batch
 
-        # process messages
-        for message in message_batch:
+    def get_url(self, message):
+        return message.body
 
-            # get image url from message
-            image_url = message.body
+    def sent_at(self, message):
+        # SentTimestamp is epoch milliseconds
+        sent_timestamp = message.attributes.get('SentTimestamp') if message.attributes else None
+        return int(sent_timestamp) / 1000.0 if sent_timestamp else None
 
-            # predict image category and persist to memcache
+    def _keep_alive(self):
+        while not self.closed.wait(self.visibility_timeout / 4.0):
             try:
-                image_pred = image_clf.run_inference_on_image(image_url)
-
-                logger.warning('%s | %s |%s' % (image_url, image_pred[0], str(image_pred[1])))
+                self.extend_visibility()
+            except (BotoCoreError, ClientError):
+                logger.error('Process %d: failed to extend visibility' % self.process_id, exc_info=True)
+
+    def extend_visibility(self):
+        '''
+        Keep every message not acked or nacked yet invisible for another visibility timeout if more than half of it
+        has been used up
+        '''
+        now = time()
+        with self.received_at_lock:
+            stale = [m for m, received in self.received_at.values() if now - received > self.visibility_timeout / 2.0]
+
+        for start in range(0, len(stale), MAX_BATCH_ENTRIES):
+            messages = stale[start:start + MAX_BATCH_ENTRIES]
+            response = self.client.change_message_visibility_batch(QueueUrl=self.queue.url, Entries=[
+                {'Id': str(i), 'ReceiptHandle': m.receipt_handle, 'VisibilityTimeout': self.visibility_timeout}
+                for i, m in enumerate(messages)])
+
+            failed = set(failure['Id'] for failure in response.get('Failed', []))
+            for failure in response.get('Failed', []):
+                logger.error('Process %d: failed to extend visibility: %s' % (self.process_id, failure))
+
+            with self.received_at_lock:
+                for i, m in enumerate(messages):
+                    # skips messages acked or nacked in the meantime
+                    if str(i) not in failed and m.message_id in self.received_at:
+                        self.received_at[m.message_id] = (m, now)
+
+    def ack(self, messages):
+        '''
+        Acknowledge a batch of messages with a single delete_message_batch call
+        '''
+        self._forget(messages)
+
+        try:
+            response = self.client.delete_message_batch(QueueUrl=self.queue.url, Entries=[
+                {'Id': str(i), 'ReceiptHandle': m.receipt_handle} for i, m in enumerate(messages)])
+        except (BotoCoreError, ClientError):
+            logger.error('Process %d: failed to delete %d messages' % (self.process_id, len(messages)), exc_info=True)
+            return
+
+        for failure in response.get('Failed', []):
+            logger.error('Process %d: failed to delete message: %s' % (self.process_id, failure))
+
+    def nack(self, messages):
+        # not deleted, so the messages become visible again and are retried once the visibility timeout expires
+        logger.error('Process %d: results not persisted, leaving %d messages on the queue'
+                     % (self.process_id, len(messages)))
+        self._forget(messages)
+
+    def close(self):
+        self.closed.set()
+
+    def _forget(self, messages):
+        with self.received_at_lock:
+            for m in messages:
+                self.received_at.pop(m.message_id, None)
+
+
+def sqs_polling(queue_name, memcache_endpoint, min_prob, config, models, metrics, process_id):
+    '''
+    Poll SQS queue - for each message received get image classification and persist result to memcache
+    '''
 
-                # write prediction to memcached if we are confident enough
-                if image_pred[1] > min_prob:
-                    memcache_client.set('%s' % hashlib.md5(image_url).hexdigest(), image_pred[0])
-                else:
-                    memcache_client.set('%s' % hashlib.md5(image_url).hexdigest(), "prediction below threshold")
+    logger.warning("Process %d: Beginning to poll SQS with %d consumers" % (process_id, config.num_sources))
 
-            except Exception:
-                logger.error("Failed to write to memcached", exc_info=True)
-                memcache_client.set('%s' % hashlib.md5(image_url).hexdigest(), "prediction error")
+    sources = [SQSSource(queue_name, process_id) for _ in range(config.num_sources)]
 
-            # messages are always deleted
-            finally:
-                message.delete()
+    run_worker(sources, memcache_endpoint, min_prob, process_id, config, models, metrics)
 
 
 def main():
-    queue_name = sys.argv[1]
-    memcache_endpoint = sys.argv[2]
-    min_prob = float(sys.argv[3])
-
-    # keep track of processes in dictionary to restart if needed i.e. {PID: Process}
-    processes = {}
-
-    num_processes = range(1, 9)
-
-    for p_num in num_processes:
-        p = multiprocessing.Process(
-            target=sqs_polling, args=(queue_name, memcache_endpoint, min_prob, p_num,))
-        p.start()
-        processes[p_num] = p
-
-    # periodically poll child processes to check if they are still alive
-    while len(processes) > 0:
-
-        # check every 5 minutes
-        sleep(300.0)
-
-        for n in processes.keys():
-            p = processes[n]
-
-            # if process is dead, create a new one to take its place
-            if not p.is_alive():
-                logger.error('Process %d is dead! Starting new process to take its place.' % n)
-                replacement_p = multiprocessing.Process(target=sqs_polling,
-                                                        args=(queue_name, memcache_endpoint, min_prob, n,))
-                replacement_p.start()
-                processes[n] = replacement_p
-
-            elif p.is_alive():
-                logger.warning('Process %d is still alive' % n)
-
-            # since polling never ends, sqs_polling should never successfully exit but we add this for completeness
-            elif p.exitcode == 0:
-                p.join()
+    parser = argparse.ArgumentParser(description='Classify image urls read from an SQS queue')
+    parser.add_argument('queue_name')
+    parser.add_argument('memcache_endpoint', help='host[:port], comma separated to shard across several servers')
+    parser.add_argument('min_prob', type=float)
+    add_execution_arguments(parser)
+    args = parser.parse_args()
+
+    num_workers, config = execution_config(args)
+
+    # parsed once here and inherited by every (re)started worker
+    models = preload_models(args.inference_mode, args.model)
+
+    # workers add to their own row of shared memory, the supervisor sums the rows when scraped
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = SharedMetrics(num_workers)
+        serve_metrics(metrics, args.metrics_port)
+
+    supervise(sqs_polling, (args.queue_name, args.memcache_endpoint, args.min_prob, config, models, metrics),
+              num_workers)
 
 
 if __name__ == "__main__":
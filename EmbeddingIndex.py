@@ -0,0 +1,183 @@
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f16"
+IDS_FILE = "ids.txt"
+
+# rows scored per matrix product when searching, bounds the float32 working set
+SEARCH_CHUNK_ROWS = 65536
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex(object):
+    '''
+    Append-only on-disk index of L2-normalized image embeddings stored as float16, memory-mapped for brute-force
+    cosine k-NN search. On disk: meta.json (dim, count), vectors.f16 (count x dim float16 rows) and ids.txt
+    (one id per row).
+    '''
+
+    def __init__(self, index_dir, dim=None):
+        self.index_dir = index_dir
+        self.vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self.ids_path = os.path.join(index_dir, IDS_FILE)
+        self.meta_path = os.path.join(index_dir, META_FILE)
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.count = meta['count']
+        else:
+            if dim is None:
+                raise ValueError("No index in %s and no dimension given to create one" % index_dir)
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            self.dim = dim
+            self.count = 0
+            open(self.vectors_path, 'wb').close()
+            open(self.ids_path, 'w').close()
+            self._write_meta()
+
+        self.ids = self._load_ids()
+        self._map_vectors()
+
+    def _load_ids(self):
+        with open(self.ids_path, 'r') as f:
+            ids = [line.rstrip("\n") for line in f]
+
+        # rows past count belong to an append that did not finish
+        if len(ids) > self.count:
+            ids = ids[:self.count]
+            with open(self.ids_path, 'w') as f:
+                for image_id in ids:
+                    f.write(image_id + "\n")
+
+        return ids
+
+    def _map_vectors(self):
+        if self.count:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(self.count, self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float16)
+
+    def _write_meta(self):
+        # written last and atomically, so a crash mid-append leaves the previous count in place
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'dim': self.dim, 'count': self.count}, f)
+        os.rename(tmp_path, self.meta_path)
+
+    def append(self, ids, vectors):
+        '''
+        Add embeddings (one row per id) to the end of the index
+        '''
+        vectors = normalize(vectors)
+
+        if vectors.shape != (len(ids), self.dim):
+            raise ValueError("Expected %d vectors of dimension %d, got %s" % (len(ids), self.dim, vectors.shape))
+
+        row_bytes = self.dim * np.dtype(np.float16).itemsize
+
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(self.count * row_bytes)
+            f.write(vectors.astype(np.float16).tobytes())
+
+        with open(self.ids_path, 'a') as f:
+            for image_id in ids:
+                f.write("%s\n" % image_id)
+
+        self.ids.extend(ids)
+        self.count += len(ids)
+        self._write_meta()
+        self._map_vectors()
+
+    def search(self, queries, k=10):
+        '''
+        Returns, for every query vector, the k most similar indexed (id, cosine similarity) pairs, best first
+        '''
+        queries = normalize(np.atleast_2d(queries))
+        k = min(k, self.count)
+
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, self.count, SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(self.vectors[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32)
+            scores = np.dot(queries, chunk.T)
+
+            # keep only each query's top k of this chunk before merging with the running top k
+            chunk_k = min(k, scores.shape[1])
+            top = np.argpartition(-scores, chunk_k - 1, axis=1)[:, :chunk_k]
+
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+
+        return [[(self.ids[row], float(score)) for row, score in zip(rows, scores)]
+                for rows, scores in zip(best_rows, best_scores)]
+
+    def __len__(self):
+        return self.count
+
+
+def main():
+    from ImageClassifier import InceptionImageClassifier, BOTTLENECK_SIZE
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Add images to, or query, a pool_3 embedding index')
+    parser.add_argument('command', choices=['add', 'query'])
+    parser.add_argument('index_dir')
+    parser.add_argument('urls_file', help='image urls, one per line')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('-k', type=int, default=10, help='neighbours returned per query image')
+    args = parser.parse_args()
+
+    index = EmbeddingIndex(args.index_dir, dim=BOTTLENECK_SIZE)
+
+    with open(args.urls_file, 'r') as f:
+        urls = [line.strip() for line in f if line.strip()]
+
+    with InceptionImageClassifier() as classifier:
+        for start in range(0, len(urls), args.batch_size):
+            batch = urls[start:start + args.batch_size]
+            embeddings = classifier.run_embedding_on_batch(batch)
+            found = [(url, e) for url, e in zip(batch, embeddings) if e is not None]
+
+            if not found:
+                continue
+
+            if args.command == 'add':
+                index.append([url for url, _ in found], [e for _, e in found])
+            else:
+                for (url, _), neighbours in zip(found, index.search([e for _, e in found], args.k)):
+                    print("%s\t%s" % (url, json.dumps(neighbours)))
+
+    logger.info("Index %s holds %d images" % (args.index_dir, len(index)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import logging
+import os
+import re
+from time import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from ImageClassifier import CustomImageClassifier, InceptionImageClassifier, INFERENCE_MODES, \
+    FROZEN_MODE, QUANTIZED_MODE, POST_DECODE_TENSOR, EMBEDDING_TENSOR, graph_path_for_mode, load_graph_def, \
+    preprocess_image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CLASSIFIERS = {'custom': CustomImageClassifier, 'inception': InceptionImageClassifier}
+
+# Only the post-decode input is fed at inference time (see import_batchable_graph), so everything upstream of it -
+# the in-graph JPEG decode and resize - is stripped along with training-only nodes. No input shape is given so the
+# batch dimension stays free after constant folding.
+OPTIMIZE_TRANSFORMS = [
+    'strip_unused_nodes(type=float)',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+]
+
+# weights stored as 8-bit with a float range and dequantized on load, computation stays float
+QUANTIZE_TRANSFORMS = ['quantize_weights']
+
+FINAL_TRANSFORMS = ['strip_unused_nodes(type=float)', 'sort_by_execution_order']
+
+
+def node_name(tensor_name):
+    return tensor_name.split(':')[0]
+
+
+def optimize_graph_def(graph_def, output_tensor_names, quantize=False):
+    '''
+    Rewrite a frozen graph (as returned by load_graph_def) for inference only, keeping the post-decode input and
+    the given output tensors
+    '''
+    transforms = OPTIMIZE_TRANSFORMS + (QUANTIZE_TRANSFORMS if quantize else []) + FINAL_TRANSFORMS
+
+    return TransformGraph(graph_def, [node_name(POST_DECODE_TENSOR)],
+                          [node_name(t) for t in output_tensor_names], transforms)
+
+
+def model_path(clf_class):
+    return clf_class.modelFullPath if clf_class is CustomImageClassifier else clf_class.graph_file
+
+
+def optimize_model(clf_class, mode):
+    '''
+    Write the optimized or quantized graph of a classifier next to its frozen graph, where preload(mode) finds it
+    '''
+    frozen_path = graph_path_for_mode(model_path(clf_class), FROZEN_MODE)
+    output_path = graph_path_for_mode(model_path(clf_class), mode)
+
+    graph_def = load_graph_def(frozen_path)
+    optimized = optimize_graph_def(graph_def, [clf_class.output_tensor_name, EMBEDDING_TENSOR],
+                                   quantize=mode == QUANTIZED_MODE)
+
+    with tf.gfile.GFile(output_path, 'wb') as f:
+        f.write(optimized.SerializeToString())
+
+    logger.info("Wrote %s graph %s: %d nodes, %.1f MB (frozen graph %d nodes, %.1f MB)"
+                % (mode, output_path, len(optimized.node), os.path.getsize(output_path) / 1e6,
+                   len(graph_def.node), os.path.getsize(frozen_path) / 1e6))
+
+
+def label_from_dir(dir_name):
+    # same normalization retrain.py applies to the image directory names it turns into labels
+    return re.sub(r'[^a-z0-9]+', ' ', dir_name.lower())
+
+
+def read_held_out(image_dir):
+    '''
+    Returns [(image path, expected label or None)] for image_dir/<label>/*.jpg, or for image_dir/*.jpg without labels
+    '''
+    images = []
+
+    for root, dirs, files in os.walk(image_dir):
+        expected = label_from_dir(os.path.basename(root)) if root != image_dir else None
+        for file_name in sorted(files):
+            if file_name.lower().endswith(('.jpg', '.jpeg')):
+                images.append((os.path.join(root, file_name), expected))
+
+    return images
+
+
+def evaluate(clf_class, mode, tensors, expected, batch_size):
+    '''
+    Top-1 labels and per-batch inference latency of one inference mode over already decoded images
+    '''
+    preloaded = clf_class.preload(mode)
+
+    with clf_class(preloaded=preloaded) as classifier:
+        classifier.warm_up()
+
+        labels = []
+        batch_seconds = []
+        for start in range(0, len(tensors), batch_size):
+            batch_start = time()
+            predictions = classifier.postprocess(tensors[start:start + batch_size], 1)
+            batch_seconds.append(time() - batch_start)
+            labels.extend(predictions.labels[:, 0])
+
+    labelled = [(label, e) for label, e in zip(labels, expected) if e is not None]
+    ms = np.array(batch_seconds) * 1000.0
+
+    return labels, {'mode': mode,
+                    'graph_mb': os.path.getsize(graph_path_for_mode(model_path(clf_class), mode)) / 1e6,
+                    'images_per_second': len(tensors) / sum(batch_seconds),
+                    'batch_p50_ms': float(np.percentile(ms, 50)),
+                    'batch_p99_ms': float(np.percentile(ms, 99)),
+                    'top1_accuracy': (float(sum(1 for label, e in labelled if label == e)) / len(labelled)
+                                      if labelled else None)}
+
+
+def compare(clf_class, modes, image_dir, batch_size):
+    '''
+    Accuracy versus latency of several inference modes on a held-out image set. Agreement is the share of images
+    whose top-1 label matches the first mode's, which works without labelled images too.
+    '''
+    held_out = read_held_out(image_dir)
+    if not held_out:
+        raise ValueError("No JPEGs found in %s" % image_dir)
+
+    # decoded once up front, so only the forward pass is timed
+    tensors = []
+    expected = []
+    for path, label in held_out:
+        try:
+            with open(path, 'rb') as f:
+                tensors.append(preprocess_image(f.read()))
+        except Exception:
+            logger.warning("Skipping unreadable image %s" % path)
+            continue
+        expected.append(label)
+
+    results = []
+    reference = None
+    for mode in modes:
+        labels, result = evaluate(clf_class, mode, tensors, expected, batch_size)
+
+        if reference is None:
+            reference = labels
+        result['agreement'] = float(sum(1 for a, b in zip(labels, reference) if a == b)) / len(labels)
+
+        logger.info("%s" % result)
+        results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write optimized inference graphs, or compare accuracy and latency '
+                                                 'of the inference modes on a held-out image set')
+    subparsers = parser.add_subparsers(dest='command')
+
+    optimize_parser = subparsers.add_parser('optimize', help='write the optimized and quantized graphs')
+    optimize_parser.add_argument('--classifier', choices=sorted(CLASSIFIERS), default='custom')
+
+    compare_parser = subparsers.add_parser('compare', help='compare inference modes on held-out images')
+    compare_parser.add_argument('image_dir', help='held-out JPEGs, in one sub-directory per label to score accuracy')
+    compare_parser.add_argument('--classifier', choices=sorted(CLASSIFIERS), default='custom')
+    compare_parser.add_argument('--modes', default=','.join(INFERENCE_MODES),
+                                help='comma separated, the first one is the reference for agreement')
+    compare_parser.add_argument('--batch-size', type=int, default=32)
+    compare_parser.add_argument('--output', help='JSON file the comparison is written to')
+
+    args = parser.parse_args()
+    clf_class = CLASSIFIERS[args.classifier]
+
+    if args.command == 'optimize':
+        for mode in INFERENCE_MODES:
+            if mode != FROZEN_MODE:
+                optimize_model(clf_class, mode)
+    else:
+        results = compare(clf_class, args.modes.split(','), args.image_dir, args.batch_size)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,55 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
+import logging
+import multiprocessing
 import os.path
 import re
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from time import time
 
 import numpy as np
 import tensorflow as tf
 import urllib2 as urllib
 import boto3
+from PIL import Image
 
 s3 = boto3.resource('s3')
 
+logger = logging.getLogger(__name__)
+
+# Both Inception v3 graphs expect a 299x299 RGB image normalized to (pixel - 128) / 128.
+INPUT_SIZE = 299
+INPUT_MEAN = 128.0
+INPUT_STD = 128.0
+
+# Images are rejected from their header, before any pixel is decoded, if they are not in one of these formats or
+# have more pixels than this (50 megapixels, well above any product photo).
+ACCEPTED_FORMATS = ('JPEG', 'PNG', 'GIF', 'BMP', 'WEBP')
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+
+# 'Mul:0' is the normalized image tensor right after the in-graph JPEG decode/resize. We remap it to a
+# batch placeholder at import time so images decoded outside the graph can be fed as one stacked tensor.
+POST_DECODE_TENSOR = 'Mul:0'
+BATCH_INPUT_NAME = 'batch_input'
+
+# The Inception graphs flatten pool_3 with a hard-coded [1, 2048] shape, which pins the batch size to 1.
+POOL_RESHAPE_SHAPE_NODE = 'pool_3/_reshape/shape'
+BOTTLENECK_SIZE = 2048
+
+# next-to-last layer, a 2048 float description of the image in both graphs
+EMBEDDING_TENSOR = 'pool_3:0'
+
+# Which frozen graph the classifiers load - the graph as trained, or one rewritten offline by GraphOptimizer.py
+# with training-only nodes stripped and constants / batch norms folded, optionally with 8-bit weights.
+FROZEN_MODE = 'frozen'
+OPTIMIZED_MODE = 'optimized'
+QUANTIZED_MODE = 'quantized'
+INFERENCE_MODES = [FROZEN_MODE, OPTIMIZED_MODE, QUANTIZED_MODE]
+
 
 class NodeLookup(object):
     """Converts integer node ID's to human readable labels."""
@@ -78,97 +117,444 @@ class NodeLookup(object):
             return ''
         return self.node_lookup[node_id]
 
+    def to_array(self, num_classes):
+        """Returns an object array of num_classes labels indexed by node ID, '' for unknown IDs."""
+        labels = np.full(num_classes, '', dtype=object)
+        for node_id, name in self.node_lookup.items():
+            if node_id < num_classes:
+                labels[node_id] = name
+        return labels
+
+
+def read_image_data(image):
+    """Returns raw encoded image bytes for an image url or for image bytes that were already downloaded."""
+    if image.startswith('http://') or image.startswith('https://'):
+        return urllib.urlopen(image).read()
+    return image
+
+
+def preprocess_image(image_data):
+    """Decodes and resizes encoded image bytes outside the graph.
+
+    JPEGs are decoded in draft mode, i.e. scaled by 1/2, 1/4 or 1/8 in the DCT domain to the smallest size that is
+    still at least INPUT_SIZE on each side, so decode time and memory follow the model's input size rather than the
+    source image.
+
+    Args:
+      image_data: encoded (e.g. JPEG) image bytes.
+
+    Returns:
+      float32 array of shape (INPUT_SIZE, INPUT_SIZE, 3) normalized the same way as the graph's 'Mul:0'.
+
+    Raises:
+      ValueError: the image is in an unsupported format, empty or too large.
+    """
+    # only the header has been read at this point
+    img = Image.open(io.BytesIO(image_data))
+
+    if img.format not in ACCEPTED_FORMATS:
+        raise ValueError("Unsupported image format %s" % img.format)
+
+    width, height = img.size
+    if width == 0 or height == 0 or width * height > MAX_IMAGE_PIXELS:
+        raise ValueError("Rejected image of %dx%d pixels" % (width, height))
+
+    img.draft('RGB', (INPUT_SIZE, INPUT_SIZE))
+    img = img.convert('RGB').resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR)
+    return (np.asarray(img, dtype=np.float32) - INPUT_MEAN) / INPUT_STD
+
+
+def load_and_preprocess(image):
+    """Returns preprocess_image of an image url or image bytes, or None if the image could not be loaded."""
+    try:
+        return preprocess_image(read_image_data(image))
+    except (ValueError, IOError) as e:
+        # unsupported, oversized or corrupt images are expected, counted as errors by the caller
+        logger.debug("Rejected image for batch inference: %s" % e)
+    except Exception:
+        logger.error("Failed to load image for batch inference", exc_info=True)
+    return None
+
+
+# top-k post-processing of a batch - rows maps each result row back to its position in the input list, labels and
+# scores are (rows, k) arrays best first, confident is a (rows,) mask of top-1 scores above the threshold
+PredictionBatch = namedtuple('PredictionBatch', ['rows', 'labels', 'scores', 'confident'])
+
+
+def top_k(predictions, k):
+    """Selects the k best classes of every row of a 2-D prediction matrix without sorting whole rows.
+
+    Args:
+      predictions: (images, classes) array of scores.
+      k: number of classes to keep per image.
+
+    Returns:
+      (indices, scores), both (images, k) arrays ordered best first.
+    """
+    k = min(k, predictions.shape[1])
+    indices = np.argpartition(-predictions, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(predictions, indices, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+# model files parsed once, e.g. in a supervisor before forking workers that share them copy-on-write
+PreloadedModel = namedtuple('PreloadedModel', ['graph_def', 'labels'])
+
+
+def graph_path_for_mode(model_path, mode):
+    """Returns the path of the graph to load for an inference mode, e.g. output_graph.quantized.pb."""
+    if mode == FROZEN_MODE:
+        return model_path
+
+    if mode not in INFERENCE_MODES:
+        raise ValueError("Unknown inference mode %s" % mode)
+
+    root, ext = os.path.splitext(model_path)
+    return '%s.%s%s' % (root, mode, ext)
+
+
+def load_graph_def(model_path):
+    """Reads a frozen GraphDef and patches it for batched inference.
+
+    Args:
+      model_path: path of the frozen graph .pb file.
+
+    Returns:
+      parsed tf.GraphDef.
+    """
+    with tf.gfile.FastGFile(model_path, 'rb') as f:
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(f.read())
 
-class InceptionImageClassifier:
-    def __init__(self):
-        # directory of inception model
-        self.model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inception-2015-12-05")
-        self.create_graph()
+    for node in graph_def.node:
+        # the retrained graph carries a DecodeJpeg attr that older TensorFlow runtimes reject
+        if node.op == 'DecodeJpeg' and 'dct_method' in node.attr:
+            del (node.attr["dct_method"])
 
-    def create_graph(self):
-        """Creates a graph from saved GraphDef file and returns a saver."""
-        # Creates graph from saved graph_def.pb.
+        if node.name == POOL_RESHAPE_SHAPE_NODE:
+            node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto([-1, BOTTLENECK_SIZE], dtype=tf.int32))
 
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                               "inception-2015-12-05/classify_image_graph_def.pb"), 'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            _ = tf.import_graph_def(graph_def, name='')
+    return graph_def
+
+
+def load_labels(labels_path):
+    """Reads one label per line, indexed by softmax node ID."""
+    with open(labels_path, 'rb') as f:
+        return [str(w).replace("\n", "") for w in f.readlines()]
+
+
+def load_model(model_path, labels_path, mode=FROZEN_MODE):
+    """Parses a retrained graph and its labels.
+
+    Args:
+      model_path: path of the frozen graph, e.g. model/output_graph.pb.
+      labels_path: path of its labels, one per line, e.g. model/output_labels_2.txt.
+      mode: one of INFERENCE_MODES, selects the graph as trained or an offline optimized version of it.
+
+    Returns:
+      PreloadedModel for CustomImageClassifier.
+    """
+    return PreloadedModel(load_graph_def(graph_path_for_mode(model_path, mode)), load_labels(labels_path))
+
+
+def import_batchable_graph(graph_def):
+    """Imports an Inception v3 GraphDef with a batch placeholder mapped onto its post-decode input.
+
+    Args:
+      graph_def: tf.GraphDef returned by load_graph_def.
+
+    Returns:
+      tf.Graph holding the imported model and a 'batch_input' placeholder of shape [None, 299, 299, 3].
+    """
+    graph = tf.Graph()
+
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, [None, INPUT_SIZE, INPUT_SIZE, 3], name=BATCH_INPUT_NAME)
+        _ = tf.import_graph_def(graph_def, input_map={POST_DECODE_TENSOR: images}, name='')
+
+    return graph
+
+
+class BatchImageClassifier(object):
+    """Shared session lifecycle and batched forward pass for the Inception based classifiers."""
+
+    output_tensor_name = None
+
+    def start_session(self, intra_op_threads=None, inter_op_threads=None):
+        """Opens the long-lived session and resolves the tensors reused across every inference call.
+
+        Args:
+          intra_op_threads: threads used inside a single op (e.g. one convolution), TensorFlow picks if None.
+            Also the number of threads images are decoded on, all cores if None.
+          inter_op_threads: ops run in parallel, TensorFlow picks if None.
+        """
+        # PIL releases the GIL while decoding, so a batch decodes in parallel on the worker's share of the cores.
+        # The pool is only started by the first preprocess_batch, classifiers of a ModelRegistry never decode.
+        self.preprocess_threads = intra_op_threads or multiprocessing.cpu_count()
+        self.preprocess_pool = None
+        self.preprocess_pool_lock = threading.Lock()
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                                inter_op_parallelism_threads=inter_op_threads or 0)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.softmax_tensor = self.graph.get_tensor_by_name(self.output_tensor_name)
+        self.input_tensor = self.graph.get_tensor_by_name(BATCH_INPUT_NAME + ':0')
+        self.embedding_tensor = self.graph.get_tensor_by_name(EMBEDDING_TENSOR)
+
+    def preprocess_batch(self, urls_or_bytes):
+        """Downloads (for urls) and decodes images into input tensors.
+
+        Args:
+          urls_or_bytes: list of image urls and/or encoded image bytes.
+
+        Returns:
+          list with one preprocessed image array per input, or None for inputs that failed to load.
+        """
+        with self.preprocess_pool_lock:
+            if self.preprocess_pool is None:
+                self.preprocess_pool = ThreadPool(self.preprocess_threads)
+
+        return self.preprocess_pool.map(load_and_preprocess, urls_or_bytes)
+
+    def predict_tensors(self, tensors):
+        """Runs one forward pass over every preprocessed image.
+
+        Args:
+          tensors: list of arrays returned by preprocess_batch, None entries are skipped.
+
+        Returns:
+          list with one row of softmax scores per input, or None where the input was None.
+        """
+        return self.run_tensor(self.softmax_tensor, tensors)
+
+    def embed_tensors(self, tensors):
+        """Computes the pool_3 image embedding of every preprocessed image in one forward pass.
+
+        Args:
+          tensors: list of arrays returned by preprocess_batch, None entries are skipped.
+
+        Returns:
+          list with one float32 array of BOTTLENECK_SIZE values per input, or None where the input was None.
+        """
+        return self.run_tensor(self.embedding_tensor, tensors)
+
+    def run_embedding_on_batch(self, urls_or_bytes):
+        """Computes pool_3 image embeddings for several images with a single forward pass.
+
+        Args:
+          urls_or_bytes: list of image urls and/or encoded image bytes.
+
+        Returns:
+          list with one float32 array of BOTTLENECK_SIZE values per image, or None where the image failed to load.
+        """
+        return self.embed_tensors(self.preprocess_batch(urls_or_bytes))
+
+    def postprocess(self, tensors, num_top_predictions, min_prob=None):
+        """Runs one forward pass and selects the top predictions of the whole batch with array operations.
+
+        Args:
+          tensors: list of arrays returned by preprocess_batch, None entries are skipped.
+          num_top_predictions: number of labels to keep per image.
+          min_prob: top-1 score an image needs to be marked confident, every image is if None.
+
+        Returns:
+          PredictionBatch.
+        """
+        rows, predictions = self.run_tensor_matrix(self.softmax_tensor, tensors)
+
+        if not rows:
+            return PredictionBatch([], np.empty((0, num_top_predictions), dtype=object),
+                                   np.empty((0, num_top_predictions), dtype=np.float32), np.empty(0, dtype=bool))
+
+        indices, scores = top_k(predictions, num_top_predictions)
+
+        if min_prob is None:
+            confident = np.ones(len(rows), dtype=bool)
+        else:
+            confident = scores[:, 0] > min_prob
+
+        return PredictionBatch(rows, self.label_array[indices], scores, confident)
+
+    def run_tensor_matrix(self, output_tensor, tensors):
+        """Evaluates output_tensor for every non-None tensor in one sess.run.
+
+        Returns:
+          (positions of the non-None tensors, 2-D array with one output row per position).
+        """
+        rows = [i for i, t in enumerate(tensors) if t is not None]
+
+        if not rows:
+            return rows, None
+
+        outputs = self.sess.run(output_tensor, {self.input_tensor: np.stack([tensors[i] for i in rows])})
+        return rows, outputs.reshape(len(rows), -1)
+
+    def run_tensor(self, output_tensor, tensors):
+        rows, outputs = self.run_tensor_matrix(output_tensor, tensors)
+        results = [None] * len(tensors)
+
+        for row, i in enumerate(rows):
+            results[i] = outputs[row]
+
+        return results
+
+    def warm_up(self):
+        """Runs one forward pass on a blank image so the first real batch doesn't pay graph initialization.
+
+        Returns:
+          seconds the warm-up inference took.
+        """
+        start = time()
+        self.predict_tensors([np.zeros((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)])
+        return time() - start
+
+    def close(self):
+        """Releases the TensorFlow session and the decode threads."""
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+        with self.preprocess_pool_lock:
+            if self.preprocess_pool is not None:
+                self.preprocess_pool.terminate()
+                self.preprocess_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class InceptionImageClassifier(BatchImageClassifier):
+    # Some useful tensors:
+    # 'softmax:0': A tensor containing the normalized prediction across
+    #   1000 labels.
+    # 'pool_3:0': A tensor containing the next-to-last layer containing 2048
+    #   float description of the image.
+    # 'DecodeJpeg/contents:0': A tensor containing a string providing JPEG
+    #   encoding of the image.
+    output_tensor_name = 'softmax:0'
+
+    # directory of inception model
+    model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inception-2015-12-05")
+    graph_file = os.path.join(model_dir, "classify_image_graph_def.pb")
+
+    def __init__(self, intra_op_threads=None, inter_op_threads=None, preloaded=None):
+        preloaded = preloaded or self.preload()
+        self.graph = import_batchable_graph(preloaded.graph_def)
+
+        # node ID --> English string lookup
+        self.node_lookup = preloaded.labels
+
+        self.start_session(intra_op_threads, inter_op_threads)
+
+        self.label_array = self.node_lookup.to_array(int(self.softmax_tensor.shape[-1]))
+
+    @classmethod
+    def preload(cls, mode=FROZEN_MODE):
+        """Parses the graph and builds the node ID --> English string lookup.
+
+        Args:
+          mode: one of INFERENCE_MODES, selects the graph as trained or an offline optimized version of it.
+
+        Returns:
+          PreloadedModel that can be shared by several InceptionImageClassifier instances.
+        """
+        return PreloadedModel(load_graph_def(graph_path_for_mode(cls.graph_file, mode)), NodeLookup(cls.model_dir))
 
     def run_inference_on_image(self, image, num_top_predictions=5):
         """Runs inference on an image.
 
         Args:
-          image: Image file name.
+          image: Image url or encoded image bytes.
+          num_top_predictions: number of (label, score) tuples to return.
 
         Returns:
-          Nothing
+          list of (human readable label, score) tuples, best first.
         """
-        # if not tf.gfile.Exists(image):
-        #     tf.logging.fatal('File does not exist %s', image)
-        # image_data = tf.gfile.FastGFile(image, 'rb').read()
-
-        fd = urllib.urlopen(image)
-        image_data = fd.read()
-
-        # Creates graph from saved GraphDef.
-        # self.create_graph()
-
-        with tf.Session() as sess:
-            # Some useful tensors:
-            # 'softmax:0': A tensor containing the normalized prediction across
-            #   1000 labels.
-            # 'pool_3:0': A tensor containing the next-to-last layer containing 2048
-            #   float description of the image.
-            # 'DecodeJpeg/contents:0': A tensor containing a string providing JPEG
-            #   encoding of the image.
-            # Runs the softmax tensor by feeding the image_data as input to the graph.
-            softmax_tensor = sess.graph.get_tensor_by_name('softmax:0')
-            predictions = sess.run(softmax_tensor,
-                                   {'DecodeJpeg/contents:0': image_data})
-            predictions = np.squeeze(predictions)
-
-            # Creates node ID --> English string lookup.
-            node_lookup = NodeLookup(self.model_dir)
-            top_k = predictions.argsort()[-num_top_predictions:][::-1]
-            tags = [(node_lookup.id_to_string(node_id), predictions[node_id]) for node_id in top_k]
-
-            return tags
-
-
-class CustomImageClassifier:
-    def __init__(self):
-        self.modelFullPath = os.path.dirname(os.path.abspath(__file__)) + "/model/output_graph.pb"
-        self.labelsFullPath = os.path.dirname(os.path.abspath(__file__)) + "/model/output_labels.txt"
-        self.create_graph()
-
-    def create_graph(self):
-        """Creates a graph from saved GraphDef file and returns a saver."""
-        # Creates graph from saved graph_def.pb.
-        with tf.gfile.FastGFile(self.modelFullPath, 'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            del (graph_def.node[1].attr["dct_method"])
-            _ = tf.import_graph_def(graph_def, name='')
+        tags = self.run_inference_on_batch([image], num_top_predictions)[0]
+        if tags is None:
+            raise ValueError("Could not load image for inference")
+        return tags
+
+    def run_inference_on_batch(self, urls_or_bytes, num_top_predictions=5):
+        """Runs inference on several images with a single forward pass.
+
+        Args:
+          urls_or_bytes: list of image urls and/or encoded image bytes.
+          num_top_predictions: number of (label, score) tuples to return per image.
+
+        Returns:
+          list with a list of (human readable label, score) tuples per image, or None where the image failed to load.
+        """
+        return self.run_inference_on_tensors(self.preprocess_batch(urls_or_bytes), num_top_predictions)
+
+    def run_inference_on_tensors(self, tensors, num_top_predictions=5):
+        """Runs inference on images already decoded by preprocess_batch, see run_inference_on_batch."""
+        batch = self.postprocess(tensors, num_top_predictions)
+        results = [None] * len(tensors)
+
+        for row, i in enumerate(batch.rows):
+            results[i] = list(zip(batch.labels[row], batch.scores[row]))
+
+        return results
+
+
+class CustomImageClassifier(BatchImageClassifier):
+    output_tensor_name = 'final_result:0'
+
+    modelFullPath = os.path.dirname(os.path.abspath(__file__)) + "/model/output_graph.pb"
+    labelsFullPath = os.path.dirname(os.path.abspath(__file__)) + "/model/output_labels.txt"
+
+    def __init__(self, intra_op_threads=None, inter_op_threads=None, preloaded=None):
+        preloaded = preloaded or self.preload()
+        self.graph = import_batchable_graph(preloaded.graph_def)
+        self.labels = preloaded.labels
+        self.label_array = np.array(self.labels, dtype=object)
+
+        self.start_session(intra_op_threads, inter_op_threads)
+
+    @classmethod
+    def preload(cls, mode=FROZEN_MODE):
+        """Parses the graph (removing the dct_method attr) and reads the labels.
+
+        Args:
+          mode: one of INFERENCE_MODES, selects the graph as trained or an offline optimized version of it.
+
+        Returns:
+          PreloadedModel that can be shared by several CustomImageClassifier instances.
+        """
+        return load_model(cls.modelFullPath, cls.labelsFullPath, mode)
 
     def run_inference_on_image(self, image_url):
+        preds = self.run_inference_on_batch([image_url])[0]
+        if preds is None:
+            raise ValueError("Could not load image for inference")
+        return preds[0]
 
-        # Creates graph from saved GraphDef.
-        image_data = urllib.urlopen(image_url).read()
+    def run_inference_on_batch(self, urls_or_bytes, num_top_predictions=1):
+        """Runs inference on several images with a single forward pass.
 
-        with tf.Session() as sess:
-            softmax_tensor = sess.graph.get_tensor_by_name('final_result:0')
-            predictions = sess.run(softmax_tensor,
-                                   {'DecodeJpeg/contents:0': image_data})
-            predictions = np.squeeze(predictions)
+        Args:
+          urls_or_bytes: list of image urls and/or encoded image bytes.
+          num_top_predictions: number of predictions to return per image.
+
+        Returns:
+          list with a list of [label, score] pairs per image, best first, or None where the image failed to load.
+        """
+        return self.run_inference_on_tensors(self.preprocess_batch(urls_or_bytes), num_top_predictions)
 
-            top_k = predictions.argsort()[-5:][::-1]  # Getting top 5 predictions
-            f = open(self.labelsFullPath, 'rb')
-            lines = f.readlines()
-            labels = [str(w).replace("\n", "") for w in lines]
+    def run_inference_on_tensors(self, tensors, num_top_predictions=1):
+        """Runs inference on images already decoded by preprocess_batch, see run_inference_on_batch."""
+        batch = self.postprocess(tensors, num_top_predictions)
+        results = [None] * len(tensors)
 
-            return [labels[top_k[0]], predictions[top_k[0]]]
+        for row, i in enumerate(batch.rows):
+            results[i] = [[label, score] for label, score in zip(batch.labels[row], batch.scores[row])]
 
+        return results
 
 
 # def main():
@@ -0,0 +1,143 @@
+import logging
+import threading
+from collections import deque, namedtuple
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# outcome of downloading one image - exactly one of data/error is set
+FetchResult = namedtuple('FetchResult', ['url', 'data', 'error', 'seconds'])
+
+
+class ImageFetcher(object):
+    '''
+    Downloads images concurrently over pooled keep-alive connections so network latency overlaps with inference.
+    timeout bounds connecting and every single read, deadline the whole download - checked between reads, so a
+    download is given up after at most deadline + timeout seconds.
+    '''
+
+    def __init__(self, num_threads=16, max_per_host=4, timeout=10.0, max_bytes=10 * 1024 * 1024, deadline=30.0):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.max_per_host = max_per_host
+
+        # one session shares keep-alive connections between all fetch threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=num_threads, pool_maxsize=num_threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pool = ThreadPool(num_threads)
+
+        # at most max_per_host downloads of a host are handed to the pool, the rest wait here without holding a
+        # thread, so one slow merchant CDN can't take every fetch thread
+        self.host_active = {}
+        self.host_waiting = {}
+        self.hosts_lock = threading.Lock()
+
+    def fetch(self, url):
+        '''
+        Download a single image, never raises - failures are returned in FetchResult.error
+        '''
+        start = time()
+
+        try:
+            response = self.session.get(url, timeout=self.timeout, stream=True)
+            try:
+                response.raise_for_status()
+
+                # reject early if the server tells us the image is too big
+                content_length = response.headers.get('Content-Length')
+                if content_length is not None and int(content_length) > self.max_bytes:
+                    raise ValueError('Image too large: %s bytes' % content_length)
+
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError('Image exceeds %d bytes' % self.max_bytes)
+                    if time() - start > self.deadline:
+                        raise ValueError('Download took more than %.0f seconds' % self.deadline)
+                    chunks.append(chunk)
+            finally:
+                response.close()
+
+            return FetchResult(url, b''.join(chunks), None, time() - start)
+
+        except Exception as e:
+            # unreachable hosts and HTTP errors are expected, the caller counts them
+            logger.debug('Failed to fetch %s: %s' % (url, e))
+            return FetchResult(url, None, e, time() - start)
+
+    def fetch_many(self, urls):
+        '''
+        Download several images concurrently, returns (list of FetchResult in input order, wall clock seconds).
+        None urls are skipped and get None in their slot.
+        '''
+        start = time()
+        results = [None] * len(urls)
+        pending = [len([url for url in urls if url is not None])]
+        finished = threading.Condition()
+
+        def done(i, result):
+            with finished:
+                results[i] = result
+                pending[0] -= 1
+                finished.notify()
+
+        for i, url in enumerate(urls):
+            if url is not None:
+                self._submit(url, partial(done, i))
+
+        with finished:
+            while pending[0]:
+                finished.wait()
+
+        return results, time() - start
+
+    def _submit(self, url, done):
+        host = urlparse(url).netloc
+        with self.hosts_lock:
+            if self.host_active.get(host, 0) >= self.max_per_host:
+                self.host_waiting.setdefault(host, deque()).append((url, done))
+                return
+            self.host_active[host] = self.host_active.get(host, 0) + 1
+
+        self.pool.apply_async(self._fetch_from_host, (host, url, done))
+
+    def _fetch_from_host(self, host, url, done):
+        try:
+            done(self.fetch(url))
+        finally:
+            # the host's slot goes straight to its next waiting download, if any
+            with self.hosts_lock:
+                waiting = self.host_waiting.get(host)
+                if waiting:
+                    next_url, next_done = waiting.popleft()
+                    if not waiting:
+                        del self.host_waiting[host]
+                else:
+                    self.host_active[host] -= 1
+                    if not self.host_active[host]:
+                        del self.host_active[host]
+                    next_url = None
+
+            if next_url is not None:
+                self.pool.apply_async(self._fetch_from_host, (host, next_url, next_done))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
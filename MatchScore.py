@@ -1,82 +1,132 @@
-# import nltk
-# import re
-# from nltk.corpus import stopwords
-# from ImageClassifier import InceptionImageClassifier
-# import itertools
-# import logging
-#
-# logging.basicConfig(level=logging.INFO)
-# logger = logging.getLogger(__name__)
-#
-#
-# class MatchScore:
-#     def __init__(self, cooccurrence_freq_file, image_tag_freq_file, title_token_freq_file):
-#         self.cooccurrence_freq = self.file_to_dictionary(cooccurrence_freq_file)
-#         self.image_tag_freq = self.file_to_dictionary(image_tag_freq_file)
-#         self.title_token_freq = self.file_to_dictionary(title_token_freq_file)
-#         self.classifier = InceptionImageClassifier()
-#         self.stopwords = set(stopwords.words('english'))
-#         self.stopwords.add("'s")
-#
-#     def file_to_dictionary(self, file_path):
-#         count_dict = {}
-#
-#         try:
-#             with open(file_path, 'r') as f:
-#                 for line in f:
-#                     term_count = line.split("|")
-#                     count_dict["".join(term_count[:-1]).rstrip()] = int(term_count[-1])
-#             f.close()
-#         except Exception:
-#             logger.error("Failed to read File: ", exc_info=True)
-#
-#         return count_dict
-#
-#     def inception_classify(self, image_url):
-#         return self.classifier.run_inference_on_image(image_url)
-#
-#     def pmi(self, image_token_pair):
-#
-#         tag_freq = self.image_tag_freq.get(image_token_pair[1], 0)
-#         token_freq = self.title_token_freq.get(image_token_pair[0], 0)
-#         cooccurrence_freq = self.cooccurrence_freq.get(str(image_token_pair), 0)
-#
-#         if cooccurrence_freq > 1:
-#             return float(cooccurrence_freq) / (tag_freq * token_freq)
-#         else:
-#             return False
-#
-#     def get_score(self, image_url, offer_title):
-#
-#         try:
-#             offer_tokens = [x.encode('utf-8') for x in list(set(nltk.word_tokenize(offer_title.lower()))) if
-#                             re.search('[a-zA-Z]', x.encode('utf-8')) and x.encode('utf-8') not in self.stopwords]
-#
-#         except Exception:
-#             logger.error("Failed to parse offer title: ", exc_info=True)
-#
-#         raw_tags = self.inception_classify(image_url)
-#
-#         if raw_tags:
-#
-#             # remove confidence score
-#             tags = [x[0] for x in raw_tags]
-#
-#             # get all (image tag, offer title token) pairs
-#             all_pairs = list(itertools.product(offer_tokens, tags))
-#
-#             # get pmi for all pairs
-#             pmis = []
-#             for pair in all_pairs:
-#                 pmi = self.pmi(pair)
-#                 if pmi:
-#                     pmis += [pmi]
-#
-#             if pmis:
-#                 return sum(pmis) / len(pmis)
-#             else:
-#                 return "No co-occurrences found"
-#
-#         else:
-#             print "could not classify image"
-#
+import nltk
+import re
+from nltk.corpus import stopwords
+from ImageClassifier import InceptionImageClassifier
+from PMIIndex import PMIIndex
+from ResultCache import LRUCache
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# loaded once per process rather than per MatchScore
+STOPWORDS = set(stopwords.words('english'))
+STOPWORDS.add("'s")
+
+HAS_LETTER = re.compile('[a-zA-Z]')
+
+# merchants resend the same titles constantly, so tokenized titles are memoized
+TITLE_CACHE_SIZE = 100000
+title_token_cache = LRUCache(max_size=TITLE_CACHE_SIZE, ttl=None)
+
+# the same image is paired with many titles, so its Inception tags are kept across batches
+IMAGE_TAG_CACHE_SIZE = 10000
+IMAGE_TAG_TTL = 3600.0
+
+
+def tokenize(offer_title):
+    '''
+    Distinct lowercased word tokens of a title that contain a letter and are not stopwords
+    '''
+    tokens = title_token_cache.get(offer_title)
+
+    if tokens is None:
+        encoded = set(x.encode('utf-8') for x in nltk.word_tokenize(offer_title.lower()))
+        tokens = tuple(x for x in encoded if HAS_LETTER.search(x) and x not in STOPWORDS)
+        title_token_cache.set(offer_title, tokens)
+
+    return tokens
+
+
+def tokenize_many(offer_titles):
+    '''
+    Tokenize a batch of titles, each distinct title is tokenized at most once
+    '''
+    tokenized = dict((offer_title, tokenize(offer_title)) for offer_title in set(offer_titles))
+    return [tokenized[offer_title] for offer_title in offer_titles]
+
+
+class MatchScore(object):
+    def __init__(self, pmi_index_dir):
+        # precomputed PMI table built offline by PMIIndex.py, memory-mapped and shared by every worker
+        self.pmi_index = PMIIndex(pmi_index_dir)
+        self.classifier = InceptionImageClassifier()
+        self.image_tags = LRUCache(max_size=IMAGE_TAG_CACHE_SIZE, ttl=IMAGE_TAG_TTL)
+
+    def inception_classify(self, image_url):
+        return self.classifier.run_inference_on_image(image_url)
+
+    def pmi(self, image_token_pair):
+        return self.pmi_index.pmi(image_token_pair[0], image_token_pair[1])
+
+    def tokenize(self, offer_title):
+        try:
+            return tokenize(offer_title)
+
+        except Exception:
+            logger.error("Failed to parse offer title: ", exc_info=True)
+            return ()
+
+    def get_tags(self, image_urls):
+        '''
+        Inception tags (without confidence scores) for each distinct image url. Images are classified at most once
+        per call, in one batch, and not at all while their tags are cached. Images that could not be classified
+        are left out.
+        '''
+        tags_by_url = {}
+        to_classify = []
+        distinct_urls = set(image_urls)
+
+        for image_url in distinct_urls:
+            image_tags = self.image_tags.get(image_url)
+            if image_tags is not None:
+                tags_by_url[image_url] = image_tags
+            else:
+                to_classify.append(image_url)
+
+        if to_classify:
+            for image_url, raw_tags in zip(to_classify, self.classifier.run_inference_on_batch(to_classify)):
+                if raw_tags:
+                    # remove confidence score
+                    image_tags = tuple(x[0] for x in raw_tags)
+                    self.image_tags.set(image_url, image_tags)
+                    tags_by_url[image_url] = image_tags
+
+        logger.debug("Classified %d of %d distinct images, image tag cache hit ratio %.2f"
+                     % (len(to_classify), len(distinct_urls), self.image_tags.hit_ratio()))
+
+        return tags_by_url
+
+    def get_score(self, image_url, offer_title):
+        return self.get_scores([image_url], [offer_title])[0]
+
+    def get_scores(self, image_urls, offer_titles):
+        '''
+        Mean PMI between each image's Inception tags and its offer title's tokens. Messages are grouped by image url
+        so each distinct image is classified once (see get_tags), and all (token, tag) pairs of the batch are scored
+        in one vectorized index lookup.
+        '''
+        try:
+            offer_tokens = tokenize_many(offer_titles)
+
+        except Exception:
+            # fall back to one title at a time so a single bad title doesn't fail the batch
+            offer_tokens = [self.tokenize(offer_title) for offer_title in offer_titles]
+
+        tags_by_url = self.get_tags(image_urls)
+        tags = [tags_by_url.get(image_url) or () for image_url in image_urls]
+
+        means = self.pmi_index.mean_pmi_many(offer_tokens, tags)
+
+        scores = []
+        for image_url, image_tags, mean in zip(image_urls, tags, means):
+            if not image_tags:
+                logger.error("could not classify image %s" % image_url)
+                scores.append("Could not classify image")
+            elif np.isnan(mean):
+                scores.append("No co-occurrences found")
+            else:
+                scores.append(float(mean))
+
+        return scores
@@ -1,92 +1,109 @@
-# import boto3
-# from MatchScore import MatchScore
-# import multiprocessing
-# import os
-# import json
-# from pymemcache.client.base import Client
-# import sys
-# import logging
-#
-# logging.basicConfig(level=logging.INFO)
-# logger = logging.getLogger(__name__)
-#
-#
-# def sqs_polling(queue_name, memcache_endpoint, coocurrence_cts, image_tag_cts, title_cts, process_id):
-#     '''
-#     Poll SQS queue - for each message received get match score between image and title and persist result to memcache
-#     '''
-#
-#     # SQS client config
-#     sqs = boto3.resource('sqs', region_name='us-east-1')
-#     queue = sqs.get_queue_by_name(QueueName=queue_name)
-#
-#     # Memcache config
-#     memcache_client = Client((memcache_endpoint, 11211))
-#
-#     # create image matcher object. This loads Inception model in memory.
-#     matcher = MatchScore(cooccurrence_freq_file=coocurrence_cts,
-#                          image_tag_freq_file=image_tag_cts,
-#                          title_token_freq_file=title_cts)
-#
-#     # poll sqs forever
-#     while 1:
-#
-#         # receives up to 10 messages at a time
-#         for message in queue.receive_messages():
-#
-#             logger.debug("Process %d: Read message: %s" % (process_id, message))
-#
-#             # get image url and title from message
-#             msg_body = json.loads(message.body)
-#             image_url = msg_body["image_url"]
-#             offer_title = msg_body["offer_title"]
-#
-#             # get match score between image and title
-#             score = matcher.get_score(image_url, offer_title)
-#
-#             try:
-#                 # write score to memcache
-#                 memcache_client.set('%s|%s' % (image_url[-200:], offer_title.replace(' ', '-')), score)
-#             except Exception:
-#                 logger.error("Process %d: Failed to write to memcache" % process_id, exc_info=True)
-#
-#             message.delete()
-#
-#
-# def main():
-#     queue_name = sys.argv[1]
-#     memcache_endpoint = sys.argv[2]
-#
-#     # count files
-#     cooccurrence_cts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "counts/cooccurrence_freq.txt")
-#     title_cts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "counts/title_token_freq.txt")
-#     image_label_cts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "counts/image_tag_freq.txt")
-#
-#     # Memcache config
-#     memcache_client = Client((memcache_endpoint, 11211))
-#
-#     # launch 4 identical polling processes
-#     p1 = multiprocessing.Process(
-#         target=sqs_polling, args=(queue_name, memcache_endpoint, cooccurrence_cts, image_label_cts, title_cts, 1,))
-#     p1.start()
-#
-#     p2 = multiprocessing.Process(
-#         target=sqs_polling, args=(queue_name, memcache_endpoint, cooccurrence_cts, image_label_cts, title_cts, 2,))
-#     p2.start()
-#
-#     p3 = multiprocessing.Process(
-#         target=sqs_polling, args=(queue_name, memcache_endpoint, cooccurrence_cts, image_label_cts, title_cts, 3,))
-#     p3.start()
-#
-#     p4 = multiprocessing.Process(
-#         target=sqs_polling, args=(queue_name, memcache_endpoint, cooccurrence_cts, image_label_cts, title_cts, 4,))
-#     p4.start()
-#
-#     p1.join()
-#     p2.join()
-#     p3.join()
-#     p4.join()
-#
-#
-# if __name__ == "__main__":
-#     main()
+import boto3
+from ClassificationPipeline import supervise
+from MatchScore import MatchScore
+from PMIIndex import update_index
+from ResultCache import create_memcache_client, set_many_with_retry
+import argparse
+import os
+import json
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def delete_messages(queue, messages):
+    '''
+    Delete a batch of messages with a single delete_messages call
+    '''
+    queue.delete_messages(Entries=[{'Id': str(i), 'ReceiptHandle': m.receipt_handle} for i, m in enumerate(messages)])
+
+
+def sqs_polling(queue_name, memcache_endpoint, pmi_index_dir, process_id):
+    '''
+    Poll SQS queue - for each message received get match score between image and title and persist result to memcache
+    '''
+
+    # SQS client config
+    sqs = boto3.resource('sqs', region_name='us-east-1', endpoint_url=os.environ.get('SQS_ENDPOINT_URL'))
+    queue = sqs.get_queue_by_name(QueueName=queue_name)
+
+    # Memcache config - comma separated endpoints are sharded over by a pooled hash client
+    memcache_client = create_memcache_client(memcache_endpoint)
+
+    # create image matcher object. This loads Inception model in memory and maps the shared PMI index.
+    matcher = MatchScore(pmi_index_dir)
+
+    # poll sqs forever
+    while 1:
+
+        # receives up to 10 messages at a time
+        message_batch = queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=20)
+
+        if not message_batch:
+            continue
+
+        logger.debug("Process %d: Read %d messages" % (process_id, len(message_batch)))
+
+        # get image url and title from messages - malformed ones would fail every retry, so they are deleted
+        parsed = []
+        malformed = []
+        for message in message_batch:
+            try:
+                msg_body = json.loads(message.body)
+                image_url, offer_title = msg_body["image_url"], msg_body["offer_title"]
+                if not image_url or not offer_title:
+                    raise ValueError("empty image_url or offer_title")
+                parsed.append((message, image_url, offer_title))
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error("Process %d: dropping malformed message %s: %s" % (process_id, message.message_id, e))
+                malformed.append(message)
+
+        if malformed:
+            delete_messages(queue, malformed)
+
+        if not parsed:
+            continue
+
+        message_batch = [message for message, _, _ in parsed]
+        image_urls = [image_url for _, image_url, _ in parsed]
+        offer_titles = [offer_title for _, _, offer_title in parsed]
+
+        # get match scores between images and titles for the whole batch at once
+        scores = matcher.get_scores(image_urls, offer_titles)
+
+        keys = ['%s|%s' % (image_url[-200:], offer_title.replace(' ', '-'))
+                for image_url, offer_title in zip(image_urls, offer_titles)]
+
+        # write scores to memcache in one round trip
+        failed = set(set_many_with_retry(memcache_client, dict(zip(keys, scores))))
+
+        # messages whose score was not written are left on the queue and retried after the visibility timeout
+        written = [m for m, key in zip(message_batch, keys) if key not in failed]
+        if failed:
+            logger.error("Process %d: %d of %d scores not written to memcached"
+                         % (process_id, len(message_batch) - len(written), len(message_batch)))
+
+        if written:
+            delete_messages(queue, written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score image/offer title matches read from an SQS queue')
+    parser.add_argument('queue_name')
+    parser.add_argument('memcache_endpoint', help='host[:port], comma separated to shard across several servers')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    args = parser.parse_args()
+
+    # count files and the PMI index precomputed from them
+    counts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "counts")
+    pmi_index_dir = os.path.join(counts_dir, "pmi_index")
+
+    # (re)build the index once here rather than in every worker, workers then memory-map the same files
+    update_index(counts_dir, pmi_index_dir)
+
+    supervise(sqs_polling, (args.queue_name, args.memcache_endpoint, pmi_index_dir), args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import logging
+import multiprocessing
+import threading
+from bisect import bisect_left
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from ClassificationPipeline import StageObserver
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'imagematching'
+
+COUNTERS = ['messages_received', 'images_classified', 'below_threshold', 'errors', 'cache_hits', 'cache_misses']
+
+# pipeline stages (see StageObserver) plus queue_lag, the time from a message being sent to it being read
+HISTOGRAMS = ['fetch', 'decode', 'inference', 'cache_write', 'ack', 'end_to_end', 'queue_lag']
+
+# histogram bucket upper bounds in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0]
+
+# per histogram: one count per bucket, one for +Inf, then the sum of observed values
+HISTOGRAM_SLOTS = len(BUCKETS) + 2
+
+
+class SharedMetrics(object):
+    '''
+    Counters and histograms of every worker in one block of shared memory, one row per worker. Created by the
+    supervisor before forking, so each worker only ever adds to its own row and the supervisor can sum all rows
+    without any message passing. Rows outlive restarted workers, so counters only ever go up.
+    '''
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.row_size = len(COUNTERS) + len(HISTOGRAMS) * HISTOGRAM_SLOTS
+        self.values = multiprocessing.RawArray('d', num_workers * self.row_size)
+
+    def worker(self, process_id):
+        '''
+        The StageObserver a worker process records its metrics with
+        '''
+        return WorkerMetrics(self, (process_id - 1) * self.row_size)
+
+    def totals(self):
+        '''
+        Element-wise sum of all worker rows
+        '''
+        totals = [0.0] * self.row_size
+        for offset in range(0, len(self.values), self.row_size):
+            row = self.values[offset:offset + self.row_size]
+            for i, value in enumerate(row):
+                totals[i] += value
+        return totals
+
+    def render(self):
+        '''
+        Worker totals in the Prometheus text exposition format
+        '''
+        totals = self.totals()
+        lines = []
+
+        for i, name in enumerate(COUNTERS):
+            metric = '%s_%s_total' % (METRIC_PREFIX, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %s' % (metric, repr(totals[i])))
+
+        lookups = totals[COUNTERS.index('cache_hits')] + totals[COUNTERS.index('cache_misses')]
+        metric = '%s_cache_hit_ratio' % METRIC_PREFIX
+        lines.append('# TYPE %s gauge' % metric)
+        lines.append('%s %s' % (metric, repr(totals[COUNTERS.index('cache_hits')] / lookups if lookups else 0.0)))
+
+        for h, name in enumerate(HISTOGRAMS):
+            base = len(COUNTERS) + h * HISTOGRAM_SLOTS
+            metric = '%s_%s_seconds' % (METRIC_PREFIX, name)
+            lines.append('# TYPE %s histogram' % metric)
+
+            cumulative = 0.0
+            for b, bound in enumerate(BUCKETS + ['+Inf']):
+                cumulative += totals[base + b]
+                lines.append('%s_bucket{le="%s"} %s' % (metric, bound, repr(cumulative)))
+
+            lines.append('%s_sum %s' % (metric, repr(totals[base + len(BUCKETS) + 1])))
+            lines.append('%s_count %s' % (metric, repr(cumulative)))
+
+        return '\n'.join(lines) + '\n'
+
+
+class WorkerMetrics(StageObserver):
+    '''
+    One worker's row of SharedMetrics, updated from all of its pipeline threads
+    '''
+
+    def __init__(self, shared, offset):
+        self.values = shared.values
+        self.offset = offset
+        self.counter_offsets = dict((name, offset + i) for i, name in enumerate(COUNTERS))
+        self.histogram_offsets = dict((name, offset + len(COUNTERS) + h * HISTOGRAM_SLOTS)
+                                      for h, name in enumerate(HISTOGRAMS))
+        self.lock = threading.Lock()
+
+    def increment(self, counter, n=1):
+        with self.lock:
+            self.values[self.counter_offsets[counter]] += n
+
+    def observe(self, stage, seconds, num_images):
+        base = self.histogram_offsets.get(stage)
+        if base is None:
+            return
+
+        with self.lock:
+            self.values[base + bisect_left(BUCKETS, seconds)] += 1
+            self.values[base + len(BUCKETS) + 1] += seconds
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), MetricsRequestHandler)
+        self.metrics = metrics
+
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    '''
+    Serve metrics.render() on http://host:port/metrics from a background thread of the calling (supervisor) process
+    '''
+    server = MetricsServer(metrics, port, host)
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    logger.warning("Serving metrics on http://%s:%d/metrics" % (host, server.server_address[1]))
+    return server
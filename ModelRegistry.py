@@ -0,0 +1,176 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+
+from ImageClassifier import CustomImageClassifier, FROZEN_MODE, graph_path_for_mode, load_model, \
+    load_and_preprocess
+
+logger = logging.getLogger(__name__)
+
+# name of the model results are written for under the plain url and content keys
+DEFAULT_MODEL = 'default'
+
+# where a model is (re)loaded from, and the modification times of its files when it was
+ModelSource = namedtuple('ModelSource', ['model_path', 'labels_path', 'mode', 'modified'])
+
+
+def modified_time(model_path, labels_path, mode=FROZEN_MODE):
+    '''
+    Modification times of a model's graph and labels files, or None if either is missing
+    '''
+    try:
+        return os.path.getmtime(graph_path_for_mode(model_path, mode)), os.path.getmtime(labels_path)
+    except OSError:
+        return None
+
+
+def model_source(model_path, labels_path, mode=FROZEN_MODE):
+    '''
+    ModelSource stamped with the current modification times - call it before reading the files, so a change made
+    while they are loaded is picked up by ModelRegistry.watch
+    '''
+    return ModelSource(model_path, labels_path, mode, modified_time(model_path, labels_path, mode))
+
+
+class ModelEntry(object):
+    '''
+    A loaded classifier and the number of forward passes currently using it. A replaced entry is closed once the
+    last of those finishes.
+    '''
+
+    def __init__(self, classifier, version):
+        self.classifier = classifier
+        self.version = version
+        self.in_use = 0
+        self.retired = False
+
+
+class ModelRegistry(object):
+    '''
+    Named retrained models served side by side by one worker. They all take the same Inception v3 input, so images
+    are decoded once for all of them. A model is replaced by loading the new graph and labels in the background
+    while the current one keeps serving, then swapping it in atomically - forward passes already running finish on
+    the old model, which is closed after the last one.
+    '''
+
+    def __init__(self, intra_op_threads=None, inter_op_threads=None, classifier_class=CustomImageClassifier):
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.classifier_class = classifier_class
+
+        self.entries = OrderedDict()
+        self.sources = {}
+        self.lock = threading.Lock()
+
+        # decoding is shared by every model, see BatchImageClassifier.start_session for the sizing
+        self.preprocess_pool = ThreadPool(intra_op_threads or multiprocessing.cpu_count())
+
+    def add(self, name, preloaded, source=None):
+        '''
+        Build and warm up a classifier for preloaded (a PreloadedModel) on the calling thread, then swap it in
+        under name. The first model added is the primary one. Returns the seconds the load took.
+        '''
+        start = time()
+        classifier = self.classifier_class(self.intra_op_threads, self.inter_op_threads, preloaded)
+        classifier.warm_up()
+
+        with self.lock:
+            old = self.entries.get(name)
+            entry = ModelEntry(classifier, old.version + 1 if old is not None else 1)
+            self.entries[name] = entry
+            if source is not None:
+                self.sources[name] = source
+
+        if old is not None:
+            self._retire(old)
+
+        seconds = time() - start
+        logger.warning("Model %s version %d ready in %.2fs" % (name, entry.version, seconds))
+        return seconds
+
+    def load(self, name, model_path, labels_path, mode=FROZEN_MODE):
+        source = model_source(model_path, labels_path, mode)
+        return self.add(name, load_model(model_path, labels_path, mode), source)
+
+    def _load_logged(self, name, model_path, labels_path, mode):
+        try:
+            self.load(name, model_path, labels_path, mode)
+        except Exception:
+            logger.error("Failed to load model %s from %s, still serving the previous version" % (name, model_path),
+                         exc_info=True)
+
+    def watch(self, interval=60.0):
+        '''
+        Reload any model whose graph or labels file changed since the version being served was read, checking right
+        away and then every interval seconds on a background thread. A worker (re)started with models preloaded
+        before a reload therefore catches up on its first check.
+        '''
+        def poll():
+            while 1:
+                with self.lock:
+                    sources = dict(self.sources)
+
+                for name, source in sources.items():
+                    modified = modified_time(source.model_path, source.labels_path, source.mode)
+                    if modified is not None and modified != source.modified:
+                        logger.warning("Model %s changed on disk, reloading" % name)
+                        self._load_logged(name, source.model_path, source.labels_path, source.mode)
+
+                sleep(interval)
+
+        t = threading.Thread(target=poll)
+        t.daemon = True
+        t.start()
+        return t
+
+    def preprocess_batch(self, urls_or_bytes):
+        '''
+        Decode images once for every model, see BatchImageClassifier.preprocess_batch
+        '''
+        return self.preprocess_pool.map(load_and_preprocess, urls_or_bytes)
+
+    def postprocess_all(self, tensors, num_top_predictions, min_prob=None):
+        '''
+        OrderedDict of model name -> PredictionBatch (see BatchImageClassifier.postprocess), primary model first
+        '''
+        with self.lock:
+            entries = list(self.entries.items())
+            for _, entry in entries:
+                entry.in_use += 1
+
+        try:
+            return OrderedDict((name, entry.classifier.postprocess(tensors, num_top_predictions, min_prob))
+                               for name, entry in entries)
+        finally:
+            for _, entry in entries:
+                self._release(entry)
+
+    def _release(self, entry):
+        with self.lock:
+            entry.in_use -= 1
+            close = entry.retired and entry.in_use == 0
+
+        if close:
+            entry.classifier.close()
+
+    def _retire(self, entry):
+        with self.lock:
+            entry.retired = True
+            close = entry.in_use == 0
+
+        if close:
+            entry.classifier.close()
+
+    def close(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+
+        for entry in entries:
+            self._retire(entry)
+
+        self.preprocess_pool.terminate()
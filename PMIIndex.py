@@ -0,0 +1,210 @@
+import argparse
+import ast
+import glob
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COOCCURRENCE_FILE = "cooccurrence_freq.txt"
+IMAGE_TAG_FILE = "image_tag_freq.txt"
+TITLE_TOKEN_FILE = "title_token_freq.txt"
+
+TOKENS_FILE = "tokens.txt"
+TAGS_FILE = "tags.txt"
+KEYS_FILE = "pair_keys.npy"
+PMI_FILE = "pair_pmi.npy"
+
+
+def read_counts(file_path):
+    '''
+    Yield (term, count) for every "term|count" line of a count file
+    '''
+    with open(file_path, 'r') as f:
+        for line in f:
+            term_count = line.split("|")
+            yield "".join(term_count[:-1]).rstrip(), int(term_count[-1])
+
+
+def build_index(counts_dir, index_dir):
+    '''
+    Precompute PMI for every (title token, image tag) pair seen together more than once, with tokens and tags
+    interned to integer ids. Pairs are stored as sorted int64 keys (token_id * num_tags + tag_id) next to a float32
+    PMI array so the index can be memory-mapped and searched without building any Python objects per pair.
+    '''
+    token_freq = dict(read_counts(os.path.join(counts_dir, TITLE_TOKEN_FILE)))
+    tag_freq = dict(read_counts(os.path.join(counts_dir, IMAGE_TAG_FILE)))
+
+    tokens = sorted(token_freq)
+    tags = sorted(tag_freq)
+    token_ids = dict((t, i) for i, t in enumerate(tokens))
+    tag_ids = dict((t, i) for i, t in enumerate(tags))
+
+    keys = []
+    pmis = []
+
+    for pair, cooccurrence_freq in read_counts(os.path.join(counts_dir, COOCCURRENCE_FILE)):
+        if cooccurrence_freq <= 1:
+            continue
+
+        # pairs were written as str((title token, image tag))
+        token, tag = ast.literal_eval(pair)
+
+        if not token_freq.get(token) or not tag_freq.get(tag):
+            continue
+
+        keys.append(token_ids[token] * len(tags) + tag_ids[tag])
+        pmis.append(float(cooccurrence_freq) / (tag_freq[tag] * token_freq[token]))
+
+    keys = np.array(keys, dtype=np.int64)
+    pmis = np.array(pmis, dtype=np.float32)
+    order = np.argsort(keys, kind='mergesort')
+
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    np.save(os.path.join(index_dir, KEYS_FILE), keys[order])
+    np.save(os.path.join(index_dir, PMI_FILE), pmis[order])
+
+    for file_name, terms in ((TOKENS_FILE, tokens), (TAGS_FILE, tags)):
+        with open(os.path.join(index_dir, file_name), 'w') as f:
+            for term in terms:
+                f.write(term + "\n")
+
+    logger.info("Built PMI index with %d pairs, %d tokens and %d tags in %s"
+                % (len(keys), len(tokens), len(tags), index_dir))
+
+
+def index_is_current(counts_dir, index_dir):
+    '''
+    True if index_dir holds an index built after the last change to any count file in counts_dir
+    '''
+    try:
+        built = os.path.getmtime(os.path.join(index_dir, KEYS_FILE))
+    except OSError:
+        return False
+
+    return all(os.path.getmtime(path) <= built for path in glob.glob(os.path.join(counts_dir, '*.txt')))
+
+
+def update_index(counts_dir, index_dir):
+    '''
+    Rebuild the index unless it is current. It is built in a temporary directory next to index_dir and renamed into
+    place, so a failed or interrupted build never leaves a partial index behind. Processes that already memory-mapped
+    the old index keep reading it until they reopen.
+    '''
+    if index_is_current(counts_dir, index_dir):
+        return
+
+    parent, name = os.path.split(os.path.abspath(index_dir))
+    tmp_dir = tempfile.mkdtemp(prefix=name + '.tmp-', dir=parent)
+
+    try:
+        build_index(counts_dir, tmp_dir)
+
+        # mkdtemp makes the directory private to its owner
+        os.chmod(tmp_dir, 0o755)
+
+        if os.path.isdir(index_dir):
+            old_dir = tempfile.mkdtemp(prefix=name + '.old-', dir=parent)
+            os.rename(index_dir, os.path.join(old_dir, name))
+            os.rename(tmp_dir, index_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(tmp_dir, index_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+class PMIIndex(object):
+    def __init__(self, index_dir):
+        # pair arrays are memory-mapped read only, so every worker process shares one copy via the page cache
+        self.keys = np.load(os.path.join(index_dir, KEYS_FILE), mmap_mode='r')
+        self.pmis = np.load(os.path.join(index_dir, PMI_FILE), mmap_mode='r')
+
+        self.token_ids = self.load_vocabulary(os.path.join(index_dir, TOKENS_FILE))
+        self.tag_ids = self.load_vocabulary(os.path.join(index_dir, TAGS_FILE))
+        self.num_tags = len(self.tag_ids)
+
+        logger.info("Loaded PMI index: %d pairs, %.1f MB memory-mapped, %d tokens, %d tags"
+                    % (len(self.keys), self.mapped_bytes() / 1e6, len(self.token_ids), self.num_tags))
+
+    def load_vocabulary(self, file_path):
+        with open(file_path, 'r') as f:
+            return dict((line.rstrip("\n"), i) for i, line in enumerate(f))
+
+    def mapped_bytes(self):
+        return self.keys.nbytes + self.pmis.nbytes
+
+    def pmi(self, token, tag):
+        '''
+        PMI of a (title token, image tag) pair, or 0.0 if they were not seen together more than once
+        '''
+        token_id = self.token_ids.get(token)
+        tag_id = self.tag_ids.get(tag)
+
+        if token_id is None or tag_id is None:
+            return 0.0
+
+        key = token_id * self.num_tags + tag_id
+        i = np.searchsorted(self.keys, key)
+
+        if i < len(self.keys) and self.keys[i] == key:
+            return float(self.pmis[i])
+        return 0.0
+
+    def mean_pmi_many(self, token_lists, tag_lists):
+        '''
+        Mean PMI over all (token, tag) pairs for many (title tokens, image tags) groups in one pass - every pair key
+        of every group is looked up with a single vectorized searchsorted. Returns a float array with NaN for groups
+        where no pair was seen together more than once.
+        '''
+        num_groups = len(token_lists)
+        keys = []
+        groups = []
+
+        for i, (tokens, tags) in enumerate(zip(token_lists, tag_lists)):
+            token_ids = np.array([self.token_ids[t] for t in tokens if t in self.token_ids], dtype=np.int64)
+            tag_ids = np.array([self.tag_ids[t] for t in tags if t in self.tag_ids], dtype=np.int64)
+
+            if len(token_ids) and len(tag_ids):
+                group_keys = np.add.outer(token_ids * self.num_tags, tag_ids).ravel()
+                keys.append(group_keys)
+                groups.append(np.full(len(group_keys), i, dtype=np.int64))
+
+        if not keys or not len(self.keys):
+            return np.full(num_groups, np.nan)
+
+        keys = np.concatenate(keys)
+        groups = np.concatenate(groups)
+
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[positions] == keys
+
+        sums = np.bincount(groups[found], weights=self.pmis[positions[found]], minlength=num_groups)
+        counts = np.bincount(groups[found], minlength=num_groups)
+
+        means = np.full(num_groups, np.nan)
+        np.divide(sums, counts, out=means, where=counts > 0)
+        return means
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Build the PMI index used by MatchScore from count files')
+    parser.add_argument('counts_dir', help='directory holding %s, %s and %s'
+                                           % (COOCCURRENCE_FILE, IMAGE_TAG_FILE, TITLE_TOKEN_FILE))
+    parser.add_argument('index_dir')
+    args = parser.parse_args()
+
+    build_index(args.counts_dir, args.index_dir)
+
+
+if __name__ == "__main__":
+    main()
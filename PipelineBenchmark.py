@@ -0,0 +1,287 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import threading
+from collections import defaultdict
+from time import time
+
+import numpy as np
+from pymemcache.test.utils import MockMemcacheClient
+
+try:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from ClassificationPipeline import ClassificationPipeline, MessageSource, StageObserver
+from ImageClassifier import CustomImageClassifier, InceptionImageClassifier, INFERENCE_MODES, FROZEN_MODE
+from ImageFetcher import ImageFetcher
+from ModelRegistry import ModelRegistry, DEFAULT_MODEL
+from ResultCache import ResultCache
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
+
+CLASSIFIERS = {'custom': CustomImageClassifier, 'inception': InceptionImageClassifier}
+
+STAGES = ['fetch', 'decode', 'inference', 'cache_write', 'ack', 'end_to_end']
+PERCENTILES = [50, 95, 99]
+
+
+class ImageRequestHandler(SimpleHTTPRequestHandler):
+    '''
+    Serves the files of the benchmark image directory, ignoring the query string that makes every url unique
+    '''
+
+    def translate_path(self, path):
+        return os.path.join(self.server.image_dir, os.path.basename(path.split('?')[0]))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, image_dir):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ImageRequestHandler)
+        self.image_dir = image_dir
+
+    def url(self, file_name, n):
+        return 'http://127.0.0.1:%d/%s?n=%d' % (self.server_address[1], file_name, n)
+
+
+class ListSource(MessageSource):
+    '''
+    In-memory stand-in for a queue - hands out a fixed list of urls in batches and counts acks
+    '''
+
+    def __init__(self, urls, batch_size):
+        self.urls = urls
+        self.batch_size = batch_size
+        self.acked = 0
+        self.nacked = 0
+
+    def receive_batches(self):
+        for start in range(0, len(self.urls), self.batch_size):
+            yield self.urls[start:start + self.batch_size]
+
+    def get_url(self, message):
+        return message
+
+    def ack(self, messages):
+        self.acked += len(messages)
+
+    def nack(self, messages):
+        self.nacked += len(messages)
+
+
+class UncachedResultCache(ResultCache):
+    '''
+    Never reports a hit, so every image goes through decode and inference, but still writes to memcache
+    '''
+
+    def get_many(self, keys):
+        return {}
+
+
+class StageTimer(StageObserver):
+    '''
+    Keeps every stage timing of a run
+    '''
+
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, num_images):
+        with self.lock:
+            self.seconds[stage].append(seconds)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def latency_summary(samples):
+    '''
+    p50/p95/p99/max in milliseconds of a list of seconds
+    '''
+    if not samples:
+        return None
+
+    ms = np.array(samples) * 1000.0
+    summary = dict(('p%d' % p, float(v)) for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES)))
+    summary['max'] = float(ms.max())
+    summary['count'] = len(samples)
+    return summary
+
+
+def benchmark_worker(args, preloaded, urls, batch_size, ready, start, results, process_id):
+    '''
+    Classify urls through a full pipeline once every worker is warm, and report timings and peak RSS
+    '''
+    image_clf = ModelRegistry(classifier_class=CLASSIFIERS[args.classifier])
+    image_clf.add(DEFAULT_MODEL, preloaded)
+
+    fetcher = ImageFetcher(num_threads=args.fetch_threads, max_per_host=args.fetch_threads)
+
+    memcache_client = MockMemcacheClient()
+    result_cache = ResultCache(memcache_client) if args.cache else UncachedResultCache(memcache_client)
+
+    source = ListSource(urls, batch_size)
+    timer = StageTimer()
+    pipeline = ClassificationPipeline([source], image_clf, result_cache, fetcher, args.min_prob, process_id,
+                                      observer=timer)
+
+    ready.put(process_id)
+    start.wait()
+
+    run_start = time()
+    failed = False
+    try:
+        pipeline.run()
+    except Exception:
+        # still report, so the parent is not left waiting for this worker
+        logger.error("Process %d: benchmark run failed" % process_id, exc_info=True)
+        failed = True
+    finally:
+        image_clf.close()
+        fetcher.close()
+
+    results.put({'process_id': process_id,
+                 'failed': failed,
+                 'seconds': time() - run_start,
+                 'acked': source.acked,
+                 'nacked': source.nacked,
+                 'stages': dict(timer.seconds),
+                 'peak_rss_mb': peak_rss_mb()})
+
+
+def run_benchmark(args, preloaded, urls, batch_size, num_workers):
+    '''
+    One timed run over urls, split evenly across num_workers forked worker processes
+    '''
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = multiprocessing.Event()
+
+    processes = [multiprocessing.Process(target=benchmark_worker,
+                                         args=(args, preloaded, urls[i::num_workers], batch_size, ready, start,
+                                               results, i + 1))
+                 for i in range(num_workers)]
+    for p in processes:
+        p.start()
+
+    # model loading and warm-up are not part of the timed run
+    for _ in processes:
+        ready.get()
+
+    run_start = time()
+    start.set()
+
+    worker_results = [results.get() for _ in processes]
+    seconds = time() - run_start
+
+    for p in processes:
+        p.join()
+
+    samples = defaultdict(list)
+    for r in worker_results:
+        for stage, stage_seconds in r['stages'].items():
+            samples[stage].extend(stage_seconds)
+
+    acked = sum(r['acked'] for r in worker_results)
+
+    return {'batch_size': batch_size,
+            'workers': num_workers,
+            'images': len(urls),
+            'acked': acked,
+            'nacked': sum(r['nacked'] for r in worker_results),
+            'failed_workers': sum(1 for r in worker_results if r['failed']),
+            'seconds': seconds,
+            'images_per_second': acked / seconds if seconds else 0.0,
+            'latency_ms': dict((stage, latency_summary(samples[stage])) for stage in STAGES),
+            'peak_rss_mb': dict((r['process_id'], r['peak_rss_mb']) for r in worker_results)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the classification pipeline offline against a local '
+                                                 'directory of JPEGs, an in-memory queue and a mock memcache')
+    parser.add_argument('image_dir', help='directory of JPEGs, served over a local HTTP server')
+    parser.add_argument('output', help='JSON file the results are written to')
+    parser.add_argument('--classifier', choices=sorted(CLASSIFIERS), default='custom')
+    parser.add_argument('--inference-mode', choices=INFERENCE_MODES, default=FROZEN_MODE)
+    parser.add_argument('--images', type=int, default=1000, help='images classified per run, cycling over image_dir')
+    parser.add_argument('--batch-sizes', type=parse_list, default=[1, 8, 32], help='comma separated')
+    parser.add_argument('--workers', type=parse_list, default=[1, 2, 4], help='comma separated')
+    parser.add_argument('--fetch-threads', type=int, default=16)
+    parser.add_argument('--min-prob', type=float, default=0.5)
+    parser.add_argument('--cache', action='store_true',
+                        help='look results up in the cache - images repeat, so most are skipped after the first pass')
+    args = parser.parse_args()
+
+    file_names = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(('.jpg', '.jpeg')))
+    if not file_names:
+        parser.error("No JPEGs found in %s" % args.image_dir)
+
+    server = ImageServer(args.image_dir)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    # a distinct url per image so the url cache never hides a fetch
+    urls = [server.url(file_names[n % len(file_names)], n) for n in range(args.images)]
+
+    # parsed once and inherited by every forked worker, as in production
+    preloaded = CLASSIFIERS[args.classifier].preload(args.inference_mode)
+
+    runs = []
+    for num_workers in args.workers:
+        for batch_size in args.batch_sizes:
+            run = run_benchmark(args, preloaded, urls, batch_size, num_workers)
+            runs.append(run)
+
+            latency = run['latency_ms']
+            print('workers %d, batch size %d: %.1f images/s, inference p99 %.1fms, end to end p99 %.1fms, '
+                  'peak RSS %.0fMB'
+                  % (num_workers, batch_size, run['images_per_second'],
+                     latency['inference']['p99'] if latency['inference'] else 0.0,
+                     latency['end_to_end']['p99'] if latency['end_to_end'] else 0.0,
+                     max(run['peak_rss_mb'].values())))
+
+    server.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(),
+                   'timestamp': time(),
+                   'classifier': args.classifier,
+                   'inference_mode': args.inference_mode,
+                   'cpu_count': multiprocessing.cpu_count(),
+                   'cache': args.cache,
+                   'image_files': len(file_names),
+                   'runs': runs}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import random
+import threading
+from collections import OrderedDict
+from time import sleep, time
+
+from pymemcache.client.base import PooledClient
+from pymemcache.client.hash import HashClient
+
+logger = logging.getLogger(__name__)
+
+# transient failures are never served from cache so the image is retried next time it is sent
+ERROR_VALUE = "prediction error"
+
+MEMCACHE_PORT = 11211
+
+
+def parse_memcache_endpoints(memcache_endpoint):
+    '''
+    Parse a comma separated list of host[:port] endpoints into (host, port) tuples
+    '''
+    servers = []
+    for endpoint in memcache_endpoint.split(','):
+        host, _, port = endpoint.strip().partition(':')
+        servers.append((host, int(port) if port else MEMCACHE_PORT))
+    return servers
+
+
+def create_memcache_client(memcache_endpoint, max_pool_size=16, timeout=2.0):
+    '''
+    Pooled memcache client - keys are sharded across endpoints by consistent hashing when several are given
+    '''
+    servers = parse_memcache_endpoints(memcache_endpoint)
+
+    if len(servers) == 1:
+        return PooledClient(servers[0], max_pool_size=max_pool_size, connect_timeout=timeout, timeout=timeout)
+
+    return HashClient(servers, use_pooling=True, max_pool_size=max_pool_size, connect_timeout=timeout,
+                      timeout=timeout)
+
+
+def set_many_with_retry(memcache_client, values, retries=3, backoff=0.1):
+    '''
+    Write all values in one pipelined set_many, retrying failed keys with exponential backoff and jitter.
+    Returns the keys that could still not be written.
+    '''
+    pending = dict(values)
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            sleep(backoff * (2 ** (attempt - 1)) * (1 + random.random()))
+
+        try:
+            failed = memcache_client.set_many(pending)
+        except Exception:
+            logger.warning("memcached set_many failed (attempt %d)" % (attempt + 1), exc_info=True)
+            continue
+
+        # older pymemcache clients return a bool rather than the list of failed keys
+        if failed is True or failed is None:
+            failed = []
+        elif failed is False:
+            failed = list(pending)
+
+        pending = dict((key, pending[key]) for key in failed if key in pending)
+        if not pending:
+            return []
+
+    logger.error("Failed to write %d keys to memcached after %d attempts" % (len(pending), retries + 1))
+    return list(pending)
+
+
+def url_key(image_url):
+    '''
+    Memcache key the classification result for an image url is stored under
+    '''
+    return '%s' % hashlib.md5(image_url).hexdigest()
+
+
+def content_key(image_data):
+    '''
+    Memcache key for the classification result of the downloaded image bytes, shared by every url serving them
+    '''
+    return 'content_%s' % hashlib.md5(image_data).hexdigest()
+
+
+def model_key(model_name, key):
+    '''
+    Key of the result of a model other than the default one, for a url_key or content_key
+    '''
+    return '%s_%s' % (model_name, key)
+
+
+class LRUCache(object):
+    '''
+    Bounded in-process cache with per-entry TTL (None to never expire) and hit/miss counters
+    '''
+
+    def __init__(self, max_size=100000, ttl=3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None or entry[1] < time():
+                self.misses += 1
+                return None
+
+            # re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time() + self.ttl if self.ttl is not None else float('inf'))
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ResultCache(object):
+    '''
+    Two tier lookup of classification results - local LRU first, then memcache - so duplicate images
+    skip the TensorFlow forward pass. memcache_client can be any pymemcache style client, e.g.
+    pymemcache.test.utils.MockMemcacheClient when running without a memcached server.
+    '''
+
+    def __init__(self, memcache_client, max_size=100000, ttl=3600.0):
+        self.memcache_client = memcache_client
+        self.local = LRUCache(max_size, ttl)
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+    def get_many(self, keys):
+        '''
+        Returns dict of key -> cached result for every key that is cached
+        '''
+        found = {}
+        remote_keys = []
+
+        for key in keys:
+            value = self.local.get(key)
+            if value is not None:
+                found[key] = value
+            else:
+                remote_keys.append(key)
+
+        if remote_keys:
+            try:
+                remote = self.memcache_client.get_many(remote_keys)
+            except Exception:
+                logger.error("Failed to read from memcached", exc_info=True)
+                remote = {}
+
+            for key in remote_keys:
+                value = remote.get(key)
+
+                # pymemcache returns bytes on Python 3, results are compared and served as text
+                if isinstance(value, bytes) and not isinstance(value, str):
+                    value = value.decode('utf-8')
+
+                if value is not None and value != ERROR_VALUE:
+                    self.local.set(key, value)
+                    found[key] = value
+                    self.memcache_hits += 1
+                else:
+                    self.memcache_misses += 1
+
+        return found
+
+    def set_many(self, values):
+        '''
+        Persist a batch of results to memcache in one round trip, and locally unless they are errors.
+        Returns the keys that could not be written to memcache.
+        '''
+        for key, value in values.items():
+            if value != ERROR_VALUE:
+                self.local.set(key, value)
+
+        if not values:
+            return []
+
+        return set_many_with_retry(self.memcache_client, values)
+
+    def stats(self):
+        return 'local hits %d, local misses %d, memcache hits %d, memcache misses %d, local hit ratio %.2f' % (
+            self.local.hits, self.local.misses, self.memcache_hits, self.memcache_misses, self.local.hit_ratio())
@@ -0,0 +1,103 @@
+from collections import namedtuple
+from time import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from BatchScheduler import AdaptiveBatchScheduler, TUNE_EVERY
+
+Batch = namedtuple('Batch', ['tensors', 'received_at'])
+
+
+def batch(num_images, age=0.0):
+    return Batch([None] * num_images, time() - age)
+
+
+def record_passes(scheduler, age, backlog, passes=TUNE_EVERY):
+    for _ in range(passes):
+        scheduler.record([batch(1, age)], 0.01, backlog)
+
+
+def test_over_target_shrinks_the_batch_limit_and_wait():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=64, max_wait=0.04, latency_target=1.0)
+
+    record_passes(scheduler, age=2.0, backlog=0)
+
+    assert scheduler.batch_limit == 48
+    assert scheduler.wait == 0.02
+
+
+def test_tuning_only_happens_every_tune_every_passes():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=64, max_wait=0.04, latency_target=1.0)
+
+    record_passes(scheduler, age=2.0, backlog=0, passes=TUNE_EVERY - 1)
+
+    assert (scheduler.batch_limit, scheduler.wait) == (64, 0.04)
+
+
+def test_batch_limit_never_drops_below_one():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=2, max_wait=0.04, latency_target=1.0)
+
+    record_passes(scheduler, age=2.0, backlog=0, passes=5 * TUNE_EVERY)
+
+    assert scheduler.batch_limit == 1
+
+
+def test_backlog_under_target_grows_the_batch_limit_up_to_the_max():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=64, max_wait=0.04, latency_target=1.0)
+    scheduler.batch_limit = 16
+
+    record_passes(scheduler, age=0.1, backlog=5)
+    assert scheduler.batch_limit == 20
+
+    record_passes(scheduler, age=0.1, backlog=5, passes=20 * TUNE_EVERY)
+    assert scheduler.batch_limit == 64
+
+
+def test_idle_well_under_target_grows_the_wait_up_to_the_max():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=64, max_wait=0.04, latency_target=1.0)
+    scheduler.wait = 0.0
+
+    record_passes(scheduler, age=0.1, backlog=0)
+    assert scheduler.wait == 0.001
+
+    record_passes(scheduler, age=0.1, backlog=0, passes=20 * TUNE_EVERY)
+    assert scheduler.wait == 0.04
+    assert scheduler.batch_limit == 64
+
+
+def test_collect_takes_queued_batches_up_to_the_limit():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=8, max_wait=0.0)
+    inbox = Queue()
+    for _ in range(5):
+        inbox.put(batch(3))
+
+    # batches are never split, so the last one overshoots the limit
+    assert [len(b.tensors) for b in scheduler.collect(inbox)] == [3, 3, 3]
+    assert inbox.qsize() == 2
+
+
+def test_collect_waits_at_most_the_wait_for_more_batches():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=8, max_wait=0.05)
+    inbox = Queue()
+    inbox.put(batch(1))
+
+    start = time()
+    collected = scheduler.collect(inbox)
+    seconds = time() - start
+
+    assert len(collected) == 1
+    assert 0.04 <= seconds < 0.5
+
+
+def test_collect_without_wait_only_takes_what_is_queued():
+    scheduler = AdaptiveBatchScheduler(max_batch_size=8, max_wait=0.0)
+    inbox = Queue()
+    inbox.put(batch(1))
+    inbox.put(batch(1))
+
+    start = time()
+    assert len(scheduler.collect(inbox)) == 2
+    assert time() - start < 0.04
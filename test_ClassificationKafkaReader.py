@@ -0,0 +1,148 @@
+from collections import namedtuple
+
+import pytest
+
+kafka = pytest.importorskip('kafka')
+kafka_errors = pytest.importorskip('kafka.errors')
+reader = pytest.importorskip('ClassificationKafkaReader')
+
+TOPIC = 'images'
+
+Record = namedtuple('Record', ['topic', 'partition', 'offset', 'value', 'timestamp'])
+
+
+class StubConsumer(object):
+    '''
+    Hands out the polls it is given and records seeks and commits
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.polls = []
+        self.assigned = set()
+        self.seeks = []
+        self.commits = []
+
+    def subscribe(self, topics, listener=None):
+        pass
+
+    def poll(self, timeout_ms=None, max_records=None):
+        return self.polls.pop(0)
+
+    def assignment(self):
+        return set(self.assigned)
+
+    def seek(self, tp, offset):
+        self.seeks.append((tp.partition, offset))
+
+    def commit(self, offsets):
+        self.commits.append(dict((tp.partition, meta.offset) for tp, meta in offsets.items()))
+
+    def close(self, autocommit=True):
+        pass
+
+
+def tp(partition):
+    return kafka.TopicPartition(TOPIC, partition)
+
+
+def records(partition, first, last):
+    return [Record(TOPIC, partition, offset, b'http://example.com/%d.jpg' % offset, -1)
+            for offset in range(first, last + 1)]
+
+
+@pytest.fixture
+def source(monkeypatch):
+    monkeypatch.setattr(reader, 'KafkaConsumer', StubConsumer)
+    source = reader.KafkaSource(TOPIC, 'group', 'localhost:9092', 1)
+    source.consumer.assigned = set([tp(0), tp(1)])
+    return source
+
+
+def poll(source, *polls):
+    source.consumer.polls.extend(polls)
+    batches = source.receive_batches()
+    return [next(batches) for _ in polls]
+
+
+def test_ack_commits_after_the_last_record(source):
+    first, = poll(source, {tp(0): records(0, 0, 1), tp(1): records(1, 5, 6)})
+
+    source.ack(first)
+
+    assert source.consumer.commits == [{0: 2, 1: 7}]
+
+
+def test_out_of_order_ack_waits_for_older_batches(source):
+    first, second = poll(source, {tp(0): records(0, 0, 1)}, {tp(0): records(0, 2, 3)})
+
+    source.ack(second)
+    assert source.consumer.commits == []
+
+    source.ack(first)
+    assert source.consumer.commits == [{0: 4}]
+
+
+def test_nack_seeks_back_and_never_commits_past_the_failed_batch(source):
+    first, second, third = poll(source, {tp(0): records(0, 0, 1)}, {tp(0): records(0, 2, 3)},
+                                {tp(0): records(0, 4, 5)})
+
+    source.nack(second)
+    assert source.consumer.seeks == [(0, 2)]
+
+    # polled again after the seek, so finishing them commits nothing
+    source.ack(third)
+    assert source.consumer.commits == []
+
+    source.ack(first)
+    assert source.consumer.commits == [{0: 2}]
+
+    redone, = poll(source, {tp(0): records(0, 2, 5)})
+    source.ack(redone)
+    assert source.consumer.commits == [{0: 2}, {0: 6}]
+
+
+def test_nack_only_blocks_the_failed_partitions(source):
+    first, second = poll(source, {tp(0): records(0, 0, 1)}, {tp(0): records(0, 2, 3), tp(1): records(1, 0, 1)})
+
+    source.nack(first)
+    source.ack(second)
+
+    assert source.consumer.seeks == [(0, 0)]
+    assert source.consumer.commits == [{1: 2}]
+
+
+def test_nack_of_a_batch_already_polled_again_does_not_seek(source):
+    first, second = poll(source, {tp(0): records(0, 0, 1)}, {tp(0): records(0, 2, 3)})
+
+    source.nack(first)
+    source.nack(second)
+
+    assert source.consumer.seeks == [(0, 0)]
+
+
+def test_revoked_partitions_are_not_committed_by_later_acks(source):
+    first, second = poll(source, {tp(0): records(0, 0, 1), tp(1): records(1, 0, 1)}, {tp(0): records(0, 2, 3)})
+
+    source.ack(second)
+    source.on_partitions_revoked([tp(0)])
+    assert source.consumer.commits == []
+
+    source.consumer.assigned = set([tp(1)])
+    source.ack(first)
+    assert source.consumer.commits == [{1: 2}]
+
+
+def test_failed_commit_is_logged_and_covered_by_the_next_one(source, monkeypatch):
+    first, second = poll(source, {tp(0): records(0, 0, 1)}, {tp(0): records(0, 2, 3)})
+
+    def fail(offsets):
+        raise kafka_errors.CommitFailedError()
+
+    commit = source.consumer.commit
+    monkeypatch.setattr(source.consumer, 'commit', fail)
+    source.ack(first)
+
+    monkeypatch.setattr(source.consumer, 'commit', commit)
+    source.ack(second)
+
+    assert source.consumer.commits == [{0: 4}]
@@ -0,0 +1,98 @@
+from time import time
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+reader = pytest.importorskip('ClassificationSQSReader')
+
+# moto 5 mocks every service with one decorator
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_sqs
+
+QUEUE_NAME = 'images'
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.delenv('SQS_ENDPOINT_URL', raising=False)
+
+    with mock_aws():
+        yield boto3.resource('sqs', region_name='us-east-1').create_queue(QueueName=QUEUE_NAME)
+
+
+@pytest.fixture
+def source(queue):
+    source = reader.SQSSource(QUEUE_NAME, 1)
+    yield source
+    source.close()
+
+
+def send(queue, *urls):
+    for url in urls:
+        queue.send_message(MessageBody=url)
+
+
+def counts(queue):
+    queue.reload()
+    return (int(queue.attributes['ApproximateNumberOfMessages']),
+            int(queue.attributes['ApproximateNumberOfMessagesNotVisible']))
+
+
+def test_receive_and_ack_deletes_the_batch(queue, source):
+    send(queue, 'http://example.com/1.jpg', 'http://example.com/2.jpg')
+
+    batch = next(source.receive_batches())
+
+    assert sorted(source.get_url(m) for m in batch) == ['http://example.com/1.jpg', 'http://example.com/2.jpg']
+    assert all(abs(source.sent_at(m) - time()) < 60 for m in batch)
+    assert counts(queue) == (0, 2)
+
+    source.ack(batch)
+
+    assert counts(queue) == (0, 0)
+    assert source.received_at == {}
+
+
+def test_nack_leaves_the_batch_for_the_visibility_timeout(queue, source):
+    send(queue, 'http://example.com/1.jpg')
+
+    batch = next(source.receive_batches())
+    source.nack(batch)
+
+    assert counts(queue) == (0, 1)
+    assert source.received_at == {}
+
+
+def test_extend_visibility_only_extends_stale_messages(queue, source, monkeypatch):
+    send(queue, 'http://example.com/1.jpg', 'http://example.com/2.jpg')
+    stale, fresh = next(source.receive_batches())
+
+    # received more than half a visibility timeout ago
+    source.received_at[stale.message_id] = (stale, time() - source.visibility_timeout)
+
+    calls = []
+    change_visibility = source.client.change_message_visibility_batch
+
+    def spy(**kwargs):
+        calls.append([entry['ReceiptHandle'] for entry in kwargs['Entries']])
+        return change_visibility(**kwargs)
+
+    monkeypatch.setattr(source.client, 'change_message_visibility_batch', spy)
+    source.extend_visibility()
+
+    assert calls == [[stale.receipt_handle]]
+    assert time() - source.received_at[stale.message_id][1] < source.visibility_timeout / 2.0
+
+    # nothing is stale any more
+    source.extend_visibility()
+    assert len(calls) == 1
+
+
+def test_queue_depth(queue, source):
+    assert source.queue_depth() == 0
+
+    send(queue, 'http://example.com/1.jpg')
+
+    assert source.queue_depth() == 1
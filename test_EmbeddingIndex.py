@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import EmbeddingIndex as embedding_index
+from EmbeddingIndex import EmbeddingIndex, META_FILE, IDS_FILE, VECTORS_FILE
+
+
+def random_vectors(n, dim=8, seed=0):
+    return np.random.RandomState(seed).randn(n, dim).astype(np.float32)
+
+
+def brute_force(vectors, queries, k):
+    vectors = embedding_index.normalize(vectors).astype(np.float16).astype(np.float32)
+    scores = np.dot(embedding_index.normalize(queries), vectors.T)
+    return [list(np.argsort(-row)[:k]) for row in scores]
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    return str(tmp_path / 'index')
+
+
+def test_opening_a_missing_index_needs_a_dimension(index_dir):
+    with pytest.raises(ValueError):
+        EmbeddingIndex(index_dir)
+
+
+def test_empty_index_returns_no_neighbours(index_dir):
+    index = EmbeddingIndex(index_dir, dim=8)
+
+    assert len(index) == 0
+    assert index.search(random_vectors(2), k=3) == [[], []]
+
+
+def test_append_rejects_vectors_of_the_wrong_shape(index_dir):
+    index = EmbeddingIndex(index_dir, dim=8)
+
+    with pytest.raises(ValueError):
+        index.append(['a', 'b'], random_vectors(2, dim=4))
+    with pytest.raises(ValueError):
+        index.append(['a'], random_vectors(2))
+
+    assert len(index) == 0
+
+
+def test_search_finds_the_most_similar_vectors(index_dir):
+    vectors = random_vectors(50)
+    index = EmbeddingIndex(index_dir, dim=8)
+    index.append(['img%d' % i for i in range(50)], vectors)
+
+    results = index.search(vectors[[3, 17]], k=5)
+
+    assert [neighbours[0][0] for neighbours in results] == ['img3', 'img17']
+    assert results[0][0][1] == pytest.approx(1.0, abs=1e-3)
+    for neighbours in results:
+        scores = [score for _, score in neighbours]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_search_across_chunks_matches_brute_force(index_dir, monkeypatch):
+    monkeypatch.setattr(embedding_index, 'SEARCH_CHUNK_ROWS', 7)
+    vectors = random_vectors(40)
+    queries = random_vectors(4, seed=1)
+    index = EmbeddingIndex(index_dir, dim=8)
+    index.append(['img%d' % i for i in range(40)], vectors)
+
+    results = index.search(queries, k=6)
+
+    assert [[image_id for image_id, _ in neighbours] for neighbours in results] == \
+        [['img%d' % row for row in rows] for rows in brute_force(vectors, queries, 6)]
+
+
+def test_k_larger_than_the_index(index_dir):
+    index = EmbeddingIndex(index_dir, dim=8)
+    index.append(['a', 'b'], random_vectors(2))
+
+    assert len(index.search(random_vectors(1, seed=1), k=10)[0]) == 2
+
+
+def test_appends_are_kept_when_the_index_is_reopened(index_dir):
+    vectors = random_vectors(6)
+    index = EmbeddingIndex(index_dir, dim=8)
+    index.append(['a', 'b', 'c'], vectors[:3])
+    index.append(['d', 'e', 'f'], vectors[3:])
+
+    reopened = EmbeddingIndex(index_dir)
+
+    assert reopened.dim == 8
+    assert reopened.ids == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert reopened.search(vectors[4], k=1)[0][0][0] == 'e'
+
+
+def test_resume_drops_an_append_that_did_not_finish(index_dir):
+    vectors = random_vectors(4)
+    index = EmbeddingIndex(index_dir, dim=8)
+    index.append(['a', 'b'], vectors[:2])
+
+    # an append that wrote its rows and ids but crashed before updating meta.json
+    with open(os.path.join(index_dir, VECTORS_FILE), 'ab') as f:
+        f.write(embedding_index.normalize(vectors[2:]).astype(np.float16).tobytes())
+    with open(os.path.join(index_dir, IDS_FILE), 'a') as f:
+        f.write('c\nd\n')
+
+    resumed = EmbeddingIndex(index_dir)
+    assert resumed.ids == ['a', 'b']
+    with open(os.path.join(index_dir, IDS_FILE), 'r') as f:
+        assert f.read() == 'a\nb\n'
+
+    # the next append overwrites the unfinished rows
+    resumed.append(['e'], vectors[3:])
+
+    assert os.path.getsize(os.path.join(index_dir, VECTORS_FILE)) == 3 * 8 * 2
+    with open(os.path.join(index_dir, META_FILE), 'r') as f:
+        assert json.load(f) == {'dim': 8, 'count': 3}
+    assert EmbeddingIndex(index_dir).search(vectors[3], k=1)[0][0][0] == 'e'
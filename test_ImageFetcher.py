@@ -0,0 +1,81 @@
+import threading
+from collections import defaultdict
+from time import sleep
+
+import pytest
+
+pytest.importorskip('requests')
+from ImageFetcher import FetchResult, ImageFetcher
+
+
+class SlowHosts(object):
+    '''
+    Stands in for ImageFetcher.fetch - urls of slow.example.com take a while, and the most downloads seen running
+    at once per host are recorded, along with the order downloads finish in
+    '''
+
+    def __init__(self):
+        self.active = defaultdict(int)
+        self.most_active = defaultdict(int)
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url):
+        host = url.split('/')[2]
+        with self.lock:
+            self.active[host] += 1
+            self.most_active[host] = max(self.most_active[host], self.active[host])
+
+        sleep(0.2 if host == 'slow.example.com' else 0.01)
+
+        with self.lock:
+            self.active[host] -= 1
+            self.finished.append(url)
+        return FetchResult(url, b'image', None, 0.0)
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = ImageFetcher(num_threads=4, max_per_host=2)
+    yield fetcher
+    fetcher.close()
+
+
+def test_results_keep_input_order_and_skip_none(fetcher, monkeypatch):
+    monkeypatch.setattr(fetcher, 'fetch', SlowHosts())
+    urls = ['http://a.example.com/1.jpg', None, 'http://b.example.com/2.jpg', 'http://a.example.com/3.jpg']
+
+    results, _ = fetcher.fetch_many(urls)
+
+    assert [r.url if r is not None else None for r in results] == urls
+
+
+def test_a_slow_host_does_not_hold_every_thread(fetcher, monkeypatch):
+    hosts = SlowHosts()
+    monkeypatch.setattr(fetcher, 'fetch', hosts)
+    slow = ['http://slow.example.com/%d.jpg' % i for i in range(6)]
+    fast = ['http://fast.example.com/%d.jpg' % i for i in range(4)]
+
+    results, _ = fetcher.fetch_many(slow + fast)
+
+    assert all(r.error is None for r in results)
+    assert hosts.most_active['slow.example.com'] == 2
+
+    # the fast host got the threads the slow one was not allowed, so it finished first
+    assert set(hosts.finished[:len(fast)]) == set(fast)
+    assert fetcher.host_active == {} and fetcher.host_waiting == {}
+
+
+def test_concurrent_batches_share_the_host_limit(fetcher, monkeypatch):
+    hosts = SlowHosts()
+    monkeypatch.setattr(fetcher, 'fetch', hosts)
+    batches = [['http://slow.example.com/%d-%d.jpg' % (b, i) for i in range(3)] for b in range(2)]
+
+    threads = [threading.Thread(target=fetcher.fetch_many, args=(batch,)) for batch in batches]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert hosts.most_active['slow.example.com'] == 2
+    assert len(hosts.finished) == 6
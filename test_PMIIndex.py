@@ -0,0 +1,136 @@
+import itertools
+import math
+import os
+
+import numpy as np
+import pytest
+
+from PMIIndex import PMIIndex, build_index, update_index, index_is_current, KEYS_FILE, \
+    COOCCURRENCE_FILE, IMAGE_TAG_FILE, TITLE_TOKEN_FILE
+
+TOKEN_FREQ = {'shoe': 4, 'red': 2, 'leather': 5, 'cheap': 3}
+TAG_FREQ = {'running shoe': 8, 'sandal': 2, 'wallet': 6}
+COOCCURRENCE_FREQ = {('shoe', 'running shoe'): 6, ('shoe', 'sandal'): 3, ('red', 'running shoe'): 2,
+                     ('leather', 'wallet'): 4,
+                     # seen together only once, never scored
+                     ('cheap', 'sandal'): 1, ('red', 'wallet'): 1}
+
+
+def write_counts(counts_dir, cooccurrence_freq=COOCCURRENCE_FREQ):
+    if not os.path.isdir(counts_dir):
+        os.makedirs(counts_dir)
+
+    for file_name, counts in ((TITLE_TOKEN_FILE, TOKEN_FREQ), (IMAGE_TAG_FILE, TAG_FREQ),
+                              (COOCCURRENCE_FILE, dict((str(pair), n) for pair, n in cooccurrence_freq.items()))):
+        with open(os.path.join(counts_dir, file_name), 'w') as f:
+            for term, count in sorted(counts.items()):
+                f.write('%s|%d\n' % (term, count))
+
+
+def legacy_mean_pmi(tokens, tags):
+    '''
+    The per-pair scoring the index replaced - mean PMI of the pairs seen together more than once, or None
+    '''
+    pmis = []
+    for token, tag in itertools.product(tokens, tags):
+        cooccurrence_freq = COOCCURRENCE_FREQ.get((token, tag), 0)
+        if cooccurrence_freq > 1:
+            pmis.append(float(cooccurrence_freq) / (TAG_FREQ[tag] * TOKEN_FREQ[token]))
+    return sum(pmis) / len(pmis) if pmis else None
+
+
+@pytest.fixture
+def index(tmp_path):
+    counts_dir = str(tmp_path / 'counts')
+    write_counts(counts_dir)
+    build_index(counts_dir, str(tmp_path / 'index'))
+    return PMIIndex(str(tmp_path / 'index'))
+
+
+def test_pmi_matches_the_count_files(index):
+    assert index.pmi('shoe', 'running shoe') == pytest.approx(6.0 / (8 * 4))
+    assert index.pmi('cheap', 'sandal') == 0.0
+    assert index.pmi('unknown', 'sandal') == 0.0
+
+
+def test_mean_pmi_many_matches_the_legacy_scoring(index):
+    groups = [(['shoe', 'red'], ['running shoe', 'sandal']),
+              (['shoe', 'unknown'], ['running shoe', 'unknown tag']),
+              (['leather', 'red'], ['wallet', 'wallet']),
+              (['cheap'], ['sandal']),
+              (['red'], ['sandal', 'wallet']),
+              ([], ['running shoe']),
+              (['shoe'], []),
+              (['unknown'], ['unknown tag'])]
+
+    means = index.mean_pmi_many([tokens for tokens, _ in groups], [tags for _, tags in groups])
+
+    assert len(means) == len(groups)
+    for mean, (tokens, tags) in zip(means, groups):
+        expected = legacy_mean_pmi(tokens, tags)
+        if expected is None:
+            assert math.isnan(mean)
+        else:
+            assert mean == pytest.approx(expected, rel=1e-6)
+
+
+def test_mean_pmi_many_without_groups(index):
+    assert len(index.mean_pmi_many([], [])) == 0
+
+
+def test_mean_pmi_many_with_an_empty_index(tmp_path):
+    counts_dir = str(tmp_path / 'counts')
+    write_counts(counts_dir, cooccurrence_freq={('shoe', 'sandal'): 1})
+    build_index(counts_dir, str(tmp_path / 'index'))
+
+    means = PMIIndex(str(tmp_path / 'index')).mean_pmi_many([['shoe']], [['sandal']])
+
+    assert np.isnan(means).all()
+
+
+def test_update_index_builds_once_and_rebuilds_when_counts_change(tmp_path):
+    counts_dir = str(tmp_path / 'counts')
+    index_dir = os.path.join(counts_dir, 'pmi_index')
+    write_counts(counts_dir)
+
+    assert not index_is_current(counts_dir, index_dir)
+    update_index(counts_dir, index_dir)
+    assert index_is_current(counts_dir, index_dir)
+
+    keys_path = os.path.join(index_dir, KEYS_FILE)
+    built = os.path.getmtime(keys_path)
+
+    # current, so left alone
+    update_index(counts_dir, index_dir)
+    assert os.path.getmtime(keys_path) == built
+
+    # the count files changed after the index was built
+    os.utime(keys_path, (built - 10, built - 10))
+    assert not index_is_current(counts_dir, index_dir)
+
+    update_index(counts_dir, index_dir)
+    assert index_is_current(counts_dir, index_dir)
+    assert PMIIndex(index_dir).pmi('shoe', 'sandal') == pytest.approx(3.0 / (2 * 4))
+
+    # no temporary or replaced directories are left behind
+    assert sorted(os.listdir(counts_dir)) == sorted([COOCCURRENCE_FILE, IMAGE_TAG_FILE, TITLE_TOKEN_FILE,
+                                                     'pmi_index'])
+
+
+def test_failed_rebuild_keeps_the_current_index(tmp_path):
+    counts_dir = str(tmp_path / 'counts')
+    index_dir = str(tmp_path / 'pmi_index')
+    write_counts(counts_dir)
+    update_index(counts_dir, index_dir)
+
+    keys_path = os.path.join(index_dir, KEYS_FILE)
+    built = os.path.getmtime(keys_path)
+    with open(os.path.join(counts_dir, COOCCURRENCE_FILE), 'a') as f:
+        f.write('not a pair|x\n')
+    os.utime(keys_path, (built - 10, built - 10))
+
+    with pytest.raises(ValueError):
+        update_index(counts_dir, index_dir)
+
+    assert PMIIndex(index_dir).pmi('shoe', 'running shoe') == pytest.approx(6.0 / (8 * 4))
+    assert sorted(os.listdir(str(tmp_path))) == ['counts', 'pmi_index']
@@ -0,0 +1,115 @@
+import pytest
+
+pytest.importorskip('pymemcache')
+from pymemcache.test.utils import MockMemcacheClient
+
+import ResultCache
+from ResultCache import ERROR_VALUE, set_many_with_retry
+
+
+class ScriptedClient(object):
+    '''
+    set_many returns (or raises) the next of results for each call and records the values it was given
+    '''
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def set_many(self, values):
+        self.calls.append(dict(values))
+        result = self.results.pop(0) if self.results else []
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ResultCache, 'sleep', lambda seconds: None)
+
+
+def test_only_failed_keys_are_retried():
+    client = ScriptedClient(['b'], [])
+
+    assert set_many_with_retry(client, {'a': 1, 'b': 2}) == []
+    assert client.calls == [{'a': 1, 'b': 2}, {'b': 2}]
+
+
+def test_keys_still_failing_after_the_last_retry_are_returned():
+    client = ScriptedClient(['b'], ['b'], ['b'])
+
+    assert set_many_with_retry(client, {'a': 1, 'b': 2}, retries=2) == ['b']
+    assert len(client.calls) == 3
+
+
+def test_exceptions_are_retried():
+    client = ScriptedClient(IOError('connection reset'), [])
+
+    assert set_many_with_retry(client, {'a': 1}) == []
+    assert client.calls == [{'a': 1}, {'a': 1}]
+
+
+@pytest.mark.parametrize('result', [True, None])
+def test_bool_or_none_success(result):
+    client = ScriptedClient(result)
+
+    assert set_many_with_retry(client, {'a': 1, 'b': 2}) == []
+    assert len(client.calls) == 1
+
+
+def test_bool_failure_retries_every_key():
+    client = ScriptedClient(False, True)
+
+    assert set_many_with_retry(client, {'a': 1, 'b': 2}) == []
+    assert client.calls == [{'a': 1, 'b': 2}, {'a': 1, 'b': 2}]
+
+
+def test_unknown_failed_keys_are_ignored():
+    client = ScriptedClient(['c'])
+
+    assert set_many_with_retry(client, {'a': 1}) == []
+    assert len(client.calls) == 1
+
+
+def test_results_are_cached_locally_and_in_memcache():
+    memcache_client = MockMemcacheClient()
+    cache = ResultCache.ResultCache(memcache_client)
+
+    assert cache.set_many({'a': 'shoe'}) == []
+
+    assert cache.get_many(['a']) == {'a': 'shoe'}
+    assert cache.local.hits == 1
+    assert memcache_client.get('a') is not None
+
+
+def test_memcache_hits_fill_the_local_cache():
+    memcache_client = MockMemcacheClient()
+    memcache_client.set('a', 'shoe')
+    cache = ResultCache.ResultCache(memcache_client)
+
+    assert cache.get_many(['a', 'b']) == {'a': 'shoe'}
+    assert (cache.memcache_hits, cache.memcache_misses) == (1, 1)
+    assert cache.local.get('a') == 'shoe'
+
+
+def test_errors_are_never_cached_locally():
+    memcache_client = MockMemcacheClient()
+    cache = ResultCache.ResultCache(memcache_client)
+
+    assert cache.set_many({'a': ERROR_VALUE}) == []
+
+    assert cache.local.get('a') is None
+    assert cache.get_many(['a']) == {}
+    assert cache.local.get('a') is None
+
+
+def test_memcache_read_failures_are_misses():
+    class BrokenClient(object):
+        def get_many(self, keys):
+            raise IOError('connection refused')
+
+    cache = ResultCache.ResultCache(BrokenClient())
+
+    assert cache.get_many(['a']) == {}
+    assert cache.memcache_misses == 1